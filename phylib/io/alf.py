@@ -119,6 +119,8 @@ class EphysAlfCreator(object):
             raise IOError("The source and target directories cannot be the same.")
         if not self.out_path.exists():
             self.out_path.mkdir()
+        # Make sure spike_clusters.npy is up to date before copying it.
+        self.model.compact_spike_clusters()
 
         with tqdm(desc="Converting to ALF", total=135) as bar:
             bar.update(10)
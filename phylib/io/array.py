@@ -12,6 +12,7 @@ from operator import itemgetter
 from pathlib import Path
 
 import numpy as np
+from scipy import sparse
 
 from phylib.utils import _as_scalar, _as_scalars
 from phylib.utils._types import _as_array
@@ -307,15 +308,22 @@ def get_excerpts(data, n_excerpts=None, excerpt_size=None):
     """Return excerpts of a data array."""
     assert n_excerpts is not None
     assert excerpt_size is not None
-    if len(data) < n_excerpts * excerpt_size:
+    n = data.shape[0]
+    if n < n_excerpts * excerpt_size:
         return data
     elif n_excerpts == 0:
         return data[:0]
     elif n_excerpts == 1:
         return data[:excerpt_size]
+    if hasattr(data, 'read_windows'):
+        # Read all excerpts of an EphysReader at once.
+        starts = [start for start, _ in excerpts(
+            n, n_excerpts=n_excerpts, excerpt_size=excerpt_size)]
+        out = data.read_windows(starts, excerpt_size)
+        return out.reshape((-1, out.shape[2]))
     out = np.concatenate([
         data_chunk(data, chunk)
-        for chunk in excerpts(len(data), n_excerpts=n_excerpts, excerpt_size=excerpt_size)])
+        for chunk in excerpts(n, n_excerpts=n_excerpts, excerpt_size=excerpt_size)])
     assert len(out) <= n_excerpts * excerpt_size
     return out
 
@@ -360,6 +368,143 @@ def _spikes_per_cluster(spike_clusters, spike_ids=None):
     return spikes_in_clusters
 
 
+# Size of the dense histogram used to count pairs of values, below which it is always used.
+# Larger histograms are only used when they are at most `_DENSE_PAIRS_RATIO` times larger than
+# the number of pairs.
+_MAX_DENSE_PAIRS = 2 ** 22
+_DENSE_PAIRS_RATIO = 4
+
+
+def _count_pairs(x, y, shape=None):
+    """Return a sparse CSR matrix `m` such that `m[i, j]` is the number of indices `k`
+    such that `x[k] == i` and `y[k] == j`.
+
+    The two arguments should be 1D arrays of non-negative integers with the same size. The
+    column indices of every row are sorted.
+
+    """
+    x = np.asarray(x, dtype=np.int64)
+    y = np.asarray(y, dtype=np.int64)
+    assert x.shape == y.shape
+    if shape is None:
+        shape = (int(x.max()) + 1 if x.size else 0, int(y.max()) + 1 if y.size else 0)
+    n_rows, n_cols = shape
+    pairs = x * n_cols + y
+    if n_rows * n_cols <= max(_MAX_DENSE_PAIRS, _DENSE_PAIRS_RATIO * x.size):
+        # Linear-time histogram when the table is small enough.
+        counts = np.bincount(pairs, minlength=n_rows * n_cols)
+        pairs = np.nonzero(counts)[0]
+        counts = counts[pairs]
+    else:
+        pairs, counts = np.unique(pairs, return_counts=True)
+    rows, cols = np.divmod(pairs, n_cols)
+    # NOTE: the pairs are sorted, so are the column indices of every row.
+    indptr = np.r_[0, np.cumsum(np.bincount(rows, minlength=n_rows))]
+    return sparse.csr_matrix((counts, cols, indptr), shape=shape)
+
+
+class SpikeIndex(object):
+    """CSR-like index of the spikes belonging to every cluster.
+
+    The index contains the spike ids sorted by cluster (`spike_ids`), and the offsets of every
+    cluster in that array (`offsets`), so that the spikes of cluster `c` are
+    `spike_ids[offsets[c]:offsets[c + 1]]`, sorted by increasing id.
+
+    The clusters modified by `update()` are stored separately, so that an update only costs
+    time proportional to the size of the affected clusters.
+
+    Constructor
+    -----------
+
+    spike_clusters : array-like
+        A 1D array of non-negative integers with the cluster of every spike.
+
+    """
+
+    # Sorted spike ids of the clusters modified by update(), {cluster_id: spike_ids}.
+    _patched = None
+
+    def __init__(self, spike_clusters):
+        spike_clusters = np.asarray(spike_clusters)
+        if not len(spike_clusters):
+            spike_clusters = spike_clusters.astype(np.int64)
+        assert spike_clusters.ndim == 1
+        assert not len(spike_clusters) or spike_clusters.min() >= 0
+        # NOTE: stable sort, so that the spikes are sorted within every cluster.
+        self.spike_ids = np.argsort(spike_clusters, kind='stable').astype(np.int64)
+        self.offsets = np.r_[0, np.cumsum(np.bincount(spike_clusters))].astype(np.int64)
+
+    @property
+    def n_clusters(self):
+        """Number of clusters, including empty ones, in the index (maximum cluster id + 1)."""
+        n = len(self.offsets) - 1
+        if self._patched:
+            n = max(n, max(self._patched) + 1)
+        return n
+
+    @property
+    def cluster_ids(self):
+        """Sorted ids of the non-empty clusters."""
+        out = np.nonzero(np.diff(self.offsets))[0]
+        if self._patched:
+            out = np.union1d(
+                out[~np.isin(out, list(self._patched))],
+                [c for c, spikes in self._patched.items() if len(spikes)]).astype(np.int64)
+        return out
+
+    def _get(self, cluster_id):
+        if self._patched and cluster_id in self._patched:
+            return self._patched[cluster_id]
+        if not 0 <= cluster_id < len(self.offsets) - 1:
+            return self.spike_ids[:0]
+        return self.spike_ids[self.offsets[cluster_id]:self.offsets[cluster_id + 1]]
+
+    def count(self, cluster_id):
+        """Number of spikes in a cluster."""
+        return len(self._get(cluster_id))
+
+    def spikes(self, clusters):
+        """Return the sorted ids of all spikes belonging to the specified clusters."""
+        clusters = _as_array(clusters).ravel()
+        if not len(clusters):
+            return np.array([], dtype=np.int64)
+        out = np.concatenate([self._get(c) for c in clusters])
+        # NOTE: the spikes of a single cluster are already sorted.
+        return np.sort(out) if len(clusters) >= 2 else out
+
+    def update(self, spike_ids, old_clusters, new_clusters):
+        """Move spikes from their old clusters to new clusters.
+
+        Parameters
+        ----------
+
+        spike_ids : array-like
+            Ids of the moved spikes, without duplicates.
+        old_clusters : array-like
+            Current cluster of every moved spike.
+        new_clusters : array-like or int
+            New cluster of every moved spike.
+
+        """
+        spike_ids = np.asarray(spike_ids, dtype=np.int64)
+        old_clusters = np.asarray(old_clusters)
+        new_clusters = np.broadcast_to(new_clusters, spike_ids.shape)
+        assert old_clusters.shape == spike_ids.shape
+        assert not len(new_clusters) or new_clusters.min() >= 0
+        if self._patched is None:
+            self._patched = {}
+        patched = {}
+        # Remove the spikes from their old clusters.
+        for cluster_id in np.unique(old_clusters):
+            spikes = self._get(cluster_id)
+            patched[cluster_id] = spikes[~np.isin(spikes, spike_ids)]
+        # Add the spikes to their new clusters.
+        for cluster_id in np.unique(new_clusters):
+            spikes = patched.get(cluster_id, self._get(cluster_id))
+            patched[cluster_id] = np.union1d(spikes, spike_ids[new_clusters == cluster_id])
+        self._patched.update({int(c): s.astype(np.int64) for c, s in patched.items()})
+
+
 def _flatten_per_cluster(per_cluster):
     """Convert a dictionary {cluster: spikes} to a spikes array."""
     return np.unique(np.concatenate(list(per_cluster.values()))).astype(np.int64)
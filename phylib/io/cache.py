@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+"""Caches of data derived from dataset files."""
+
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+from collections import OrderedDict
+import hashlib
+import logging
+from pathlib import Path
+from threading import Lock
+
+from phylib.utils._misc import load_pickle, save_pickle, ensure_dir_exists
+
+logger = logging.getLogger(__name__)
+
+
+#------------------------------------------------------------------------------
+# Cache
+#------------------------------------------------------------------------------
+
+def file_fingerprint(paths, **params):
+    """Return a hash of the name, size, and modification time of some files, and of
+    extra parameters.
+
+    Missing files (None or nonexistent paths) are part of the fingerprint too, so that creating
+    them changes the fingerprint.
+
+    """
+    items = []
+    for path in paths:
+        if path is None or not Path(path).exists():
+            items.append((str(path), None, None))
+            continue
+        path = Path(path)
+        stat = path.stat()
+        items.append((path.name, stat.st_size, stat.st_mtime_ns))
+    items.extend(sorted(params.items()))
+    return hashlib.sha1(repr(items).encode('utf-8')).hexdigest()
+
+
+class DiskCache(object):
+    """On-disk cache of derived data.
+
+    Every entry is saved along with a key, typically a fingerprint of the source files, and is
+    discarded as soon as the key changes.
+
+    Constructor
+    -----------
+
+    cache_dir : str or Path
+        Path to the cache directory, created on the first write.
+
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir)
+
+    def _path(self, name):
+        return self.cache_dir / ('%s.pkl' % name)
+
+    def load(self, name, key):
+        """Return a cached entry, or None if it does not exist or is outdated."""
+        path = self._path(name)
+        if not path.exists():
+            return
+        try:
+            entry = load_pickle(path)
+        except Exception as e:  # pragma: no cover
+            logger.debug("Unable to read cache entry %s: %s.", path, e)
+            return
+        if not isinstance(entry, dict) or entry.get('key', None) != key:
+            logger.debug("Cache entry `%s` is outdated.", name)
+            return
+        logger.debug("Loaded `%s` from the cache.", name)
+        return entry['data']
+
+    def save(self, name, key, data):
+        """Save an entry in the cache. Failures are logged but not raised, for example when
+        the dataset directory is read-only."""
+        path = self._path(name)
+        try:
+            ensure_dir_exists(self.cache_dir)
+            save_pickle(path, {'key': key, 'data': data})
+            logger.debug("Saved `%s` to the cache.", name)
+        except (IOError, OSError) as e:  # pragma: no cover
+            logger.warning("Unable to write cache entry %s: %s.", path, e)
+
+    def get(self, name, key, compute):
+        """Return a cached entry, or compute it with `compute()` and save it in the cache."""
+        data = self.load(name, key)
+        if data is None:
+            data = compute()
+            self.save(name, key, data)
+        return data
+
+    def clear(self):
+        """Remove all entries from the cache."""
+        if not self.cache_dir.exists():
+            return
+        for path in self.cache_dir.glob('*.pkl'):
+            path.unlink()
+
+
+class LRUCache(object):
+    """Thread-safe in-memory least recently used cache, with a budget in bytes.
+
+    The least recently used entries are evicted when the total size of the entries exceeds
+    the budget. Entries larger than the budget are not cached.
+
+    Constructor
+    -----------
+
+    max_bytes : int
+        Maximum total size of the entries, in bytes. The cache is disabled if 0.
+
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """Return an entry and mark it as the most recently used one, or return `default`."""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key, value, nbytes=None):
+        """Add an entry of a given size (by default, `value.nbytes`) to the cache."""
+        nbytes = nbytes if nbytes is not None else value.nbytes
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+            # Evict the least recently used entries.
+            while self.nbytes > self.max_bytes:
+                _, (_, size) = self._entries.popitem(last=False)
+                self.nbytes -= size
+
+    def clear(self):
+        """Remove all entries from the cache."""
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    @property
+    def hit_rate(self):
+        """Fraction of the get() calls that found the requested entry."""
+        n = self.hits + self.misses
+        return self.hits / float(n) if n else 0.
+
+    def stats(self):
+        """Return a dictionary with the number of entries, size, hits, misses, and hit rate."""
+        return {
+            'n_entries': len(self), 'nbytes': self.nbytes, 'max_bytes': self.max_bytes,
+            'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hit_rate}
@@ -7,24 +7,28 @@
 # Imports
 #------------------------------------------------------------------------------
 
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import os
 import os.path as op
+import zlib
 from operator import itemgetter
 from pathlib import Path
 import shutil
 
 import numpy as np
-# from numpy.lib.format import open_memmap
+from numpy.lib.format import open_memmap
 import scipy.io as sio
+from scipy import sparse
 # from tqdm import tqdm
 
-from .array import _index_of, _spikes_in_clusters, _spikes_per_cluster, SpikeSelector
+from .array import _index_of, _count_pairs, SpikeIndex, SpikeSelector
+from .cache import DiskCache, LRUCache, file_fingerprint
 from .traces import (
     get_ephys_reader, RandomEphysReader, extract_waveforms,
     get_spike_waveforms, export_waveforms)
 from phylib.utils import Bunch
-from phylib.utils._misc import _write_tsv_simple, read_tsv, read_python
+from phylib.utils._misc import _write_tsv_simple, read_tsv, read_python, ensure_dir_exists
 from phylib.utils.geometry import linear_positions
 
 logger = logging.getLogger(__name__)
@@ -34,6 +38,54 @@ logger = logging.getLogger(__name__)
 # Utility functions
 #------------------------------------------------------------------------------
 
+# Number of array elements processed at once when scanning arrays for nan and inf values.
+SANITIZE_CHUNK_SIZE = 2 ** 20
+
+
+def _iter_row_chunks(arr, chunk_size=None):
+    """Yield views of consecutive blocks of rows of an array, with about `chunk_size` elements
+    each."""
+    chunk_size = chunk_size or SANITIZE_CHUNK_SIZE
+    row_size = max(1, arr.size // max(1, arr.shape[0]))
+    n_rows = max(1, chunk_size // row_size)
+    for i in range(0, arr.shape[0], n_rows):
+        yield arr[i:i + n_rows]
+
+
+def _sanitize_array(arr, path=None, chunk_size=None):
+    """Replace nan and inf values by zero, in place, block by block so that the temporary masks
+    have a bounded size."""
+    # Only floating point arrays can contain nan and inf values.
+    if arr.dtype.kind not in 'fc':
+        return arr
+    n_bad = {'nan': 0, 'inf': 0}
+    for block in _iter_row_chunks(np.atleast_1d(arr), chunk_size=chunk_size):
+        for w in ('nan', 'inf'):
+            errors = getattr(np, 'is' + w)(block)
+            n = np.count_nonzero(errors)
+            if n:
+                n_bad[w] += n
+                block[errors] = 0
+    for w, n in n_bad.items():
+        if n:
+            logger.warning(
+                "%d/%d values are %s in %s, replacing by zero.", n, arr.size, w, path)
+    return arr
+
+
+def _find_empty_rows(arr, chunk_size=None):
+    """Return a boolean mask of the rows (first axis) of an array that only contain nan values,
+    reading the array block by block so that memmapped arrays are not loaded in memory."""
+    if arr.dtype.kind not in 'fc':  # pragma: no cover
+        return np.zeros(arr.shape[0], dtype=bool)
+    out = np.zeros(arr.shape[0], dtype=bool)
+    i = 0
+    for block in _iter_row_chunks(arr, chunk_size=chunk_size):
+        out[i:i + block.shape[0]] = np.isnan(block).reshape((block.shape[0], -1)).all(axis=1)
+        i += block.shape[0]
+    return out
+
+
 def read_array(path, mmap_mode=None):
     """Read a binary array in npy or mat format, avoiding nan and inf values."""
     path = Path(path)
@@ -43,25 +95,102 @@ def read_array(path, mmap_mode=None):
         out = sio.loadmat(path)[arr_name]
     elif ext == '.npy':
         out = np.load(path, mmap_mode=mmap_mode)
-    # Filter out nan and inf values.
-    # NOTE: do not check for nan/inf values on mmap arrays.
-    # TODO: virtual memmap array where the replacement is done on-the-fly when reading the array.
+    # Filter out nan and inf values, chunk by chunk to avoid large temporary masks.
+    # NOTE: do not check for nan/inf values on mmap arrays, which would read the whole file.
+    # Callers can use the copy-on-write mode 'c' and _find_empty_rows() on specific arrays.
     if mmap_mode is None:
-        for w in ('nan', 'inf'):
-            errors = getattr(np, 'is' + w)(out)
-            if np.any(errors):
-                n = np.sum(errors)
-                n_tot = errors.size
-                logger.warning("%d/%d values are %s in %s, replacing by zero.", n, n_tot, w, path)
-                out[errors] = 0
+        _sanitize_array(out, path=path)
     return out
 
 
+def _array_checksum(arr):
+    """Return a fast checksum of the contents of an array."""
+    arr = np.ascontiguousarray(arr)
+    return '%s-%s-%08x' % (arr.dtype.str, arr.shape, zlib.adler32(memoryview(arr).cast('B')))
+
+
 def write_array(name, arr):
     """Save an array to a binary file."""
     np.save(name, arr)
 
 
+def _write_array_atomic(path, arr):
+    """Save an array to a npy file through a temporary file, so that the file is never left
+    half-written."""
+    path = Path(path)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        np.save(f, arr)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+#------------------------------------------------------------------------------
+# Spike clusters journal
+#------------------------------------------------------------------------------
+
+def _journal_path(spike_clusters_path):
+    """Return the path to the journal of a spike clusters file."""
+    return Path(spike_clusters_path).with_suffix('.journal')
+
+
+def append_spike_clusters_journal(path, spike_ids, old_clusters, new_clusters):
+    """Append an action to a spike clusters journal.
+
+    The journal is a flat binary file of int64 triplets. Every action starts with a header
+    `(-1, n, 0)` followed by n triplets `(spike_id, old_cluster, new_cluster)`.
+
+    """
+    spike_ids = np.asarray(spike_ids)
+    n = len(spike_ids)
+    records = np.empty((n + 1, 3), dtype=np.int64)
+    records[0] = (-1, n, 0)
+    records[1:, 0] = spike_ids
+    records[1:, 1] = old_clusters
+    records[1:, 2] = new_clusters
+    with open(path, 'ab') as f:
+        f.write(records.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def load_spike_clusters_journal(path):
+    """Load the actions saved in a spike clusters journal.
+
+    Return a list of Bunch instances with `spike_ids`, `old_clusters`, and `new_clusters`
+    arrays. An incomplete last action, for example after a crash, is ignored.
+
+    """
+    path = Path(path)
+    if not path.exists():
+        return []
+    data = np.fromfile(path, dtype=np.int64)
+    n = len(data) // 3
+    data = data[:3 * n].reshape((n, 3))
+    actions = []
+    i = 0
+    while i < n:
+        if data[i, 0] != -1 or i + 1 + data[i, 1] > n:
+            logger.warning("Ignoring the incomplete end of the journal %s.", path)
+            break
+        block = data[i + 1:i + 1 + data[i, 1]]
+        actions.append(Bunch(
+            spike_ids=block[:, 0], old_clusters=block[:, 1], new_clusters=block[:, 2]))
+        i += 1 + data[i, 1]
+    return actions
+
+
+def _replay_spike_clusters_journal(spike_clusters, path):
+    """Apply, in place, the actions saved in the journal of a spike clusters file."""
+    actions = load_spike_clusters_journal(_journal_path(path))
+    if actions:
+        logger.debug("Replaying %d actions from the spike clusters journal.", len(actions))
+    for action in actions:
+        spike_clusters[action.spike_ids] = action.new_clusters
+    return spike_clusters
+
+
 def from_sparse(data, cols, channel_ids):
     """Convert a sparse structure into a dense one.
 
@@ -161,6 +290,81 @@ def get_closest_channels(channel_positions, channel_index, n=None):
     return out
 
 
+def get_channel_neighbors(channel_positions, n=None, channel_shanks=None):
+    """Return a (n_channels, n) array with, on every row, the n channels closest to a given
+    channel by increasing distance, as in `get_closest_channels()`.
+
+    If `channel_shanks` is specified, the channels on another shank are replaced by -1.
+
+    """
+    n_channels = len(channel_positions)
+    n = min(n or n_channels, n_channels)
+    d = ((channel_positions[:, np.newaxis, :] - channel_positions[np.newaxis, :, :]) ** 2)
+    # NOTE: same sort as in get_closest_channels(), row by row.
+    out = np.argsort(d.sum(axis=2), axis=1)[:, :n].astype(np.int64)
+    assert np.all(out[:, 0] == np.arange(n_channels))
+    if channel_shanks is not None:
+        channel_shanks = np.asarray(channel_shanks)
+        out[channel_shanks[out] != channel_shanks[:, np.newaxis]] = -1
+    return out
+
+
+def _argsort_decreasing(values, mask):
+    """Row by row equivalent of `np.argsort(values[mask])[::-1]`, the masked-out columns
+    being put at the end of every row."""
+    k = values.shape[1]
+    key = np.where(mask, -values, np.inf)[:, ::-1]
+    return k - 1 - np.argsort(key, axis=1, kind='stable')
+
+
+def _best_channels_from_amplitudes(amplitudes, neighbors, amplitude_threshold=0):
+    """Find the best channels of several templates at once.
+
+    Parameters
+    ----------
+
+    amplitudes : array-like
+        A (n_templates, n_channels) array with the peak-to-peak amplitude of every template on
+        every channel.
+    neighbors : array-like
+        The (n_channels, n) neighborhood table returned by `get_channel_neighbors()`.
+    amplitude_threshold : float
+        Fraction of the peak amplitude required by the neighbors of the peak channel to be kept.
+
+    Returns
+    -------
+
+    best_channels : Bunch
+        A Bunch with `best_channel` (peak channel of every template), `n_channels` (number of
+        best channels of every template), and `channel_ids` and `amplitude`, two
+        (n_templates, n) arrays with the best channels ordered by decreasing amplitude, padded
+        with -1 and 0 respectively.
+
+    """
+    n_templates = amplitudes.shape[0]
+    rows = np.arange(n_templates)[:, np.newaxis]
+    best_channel = np.argmax(amplitudes, axis=1)
+    max_amp = amplitudes[rows[:, 0], best_channel]
+    # Neighbors of the peak channels, sorted by channel id.
+    channel_ids = np.sort(neighbors[best_channel], axis=1)
+    valid = channel_ids >= 0
+    amplitude = np.where(valid, amplitudes[rows, np.maximum(channel_ids, 0)], 0)
+    # Keep the channels with X% of the peak amplitude.
+    valid &= amplitude >= amplitude_threshold * max_amp[:, np.newaxis]
+    # Order the channels by decreasing amplitude.
+    order = _argsort_decreasing(amplitude, valid)
+    valid = valid[rows, order]
+    channel_ids = np.where(valid, channel_ids[rows, order], -1)
+    amplitude = np.where(valid, amplitude[rows, order], 0)
+    assert np.all(channel_ids[:, 0] == best_channel)
+    return Bunch(
+        channel_ids=channel_ids,
+        amplitude=amplitude,
+        best_channel=best_channel,
+        n_channels=valid.sum(axis=1),
+    )
+
+
 #------------------------------------------------------------------------------
 # PC computation
 #------------------------------------------------------------------------------
@@ -279,7 +483,58 @@ def _close_memmap(name, obj):
 # Special spike_*.npy files that should not be considered as "spike attributes".
 SKIP_SPIKE_ATTRS = ('clusters', 'templates', 'samples', 'times', 'times_reordered', 'amplitudes')
 
+# Filename patterns of the source files of data that is cached on disk.
+DATA_FILES = {
+    'spike_templates': ('spike_templates.npy', 'spikes.templates*.npy'),
+    'spike_clusters': ('spike_clusters.npy', 'spikes.clusters*.npy'),
+    'templates': ('templates.npy', 'templates.waveforms.npy', 'templates.waveforms.*.npy'),
+    'template_ind': ('template_ind.npy', 'templates.waveformsChannels*.npy'),
+    'channel_positions': ('channel_positions.npy', 'channels.localCoordinates*.npy'),
+    'channel_shanks': ('channel_shanks.npy', 'channels.shanks*.npy'),
+    'spike_clusters_journal': ('spike_clusters.journal', 'spikes.clusters*.journal'),
+}
+
+# Filename patterns of the arrays that are fully loaded in memory (not memmapped), and that
+# can be read concurrently when loading a dataset.
+PREFETCHED_FILES = (
+    'spike_*.npy', 'spikes.*.npy', 'amplitudes.npy', 'channel_map.npy', 'channels.*.npy',
+    'channel_probe.npy', 'channel_positions.npy', 'channel_shanks.npy', 'template_ind.npy',
+    'templates.waveformsChannels*.npy', 'template_clusters.npy', 'whitening_mat.npy',
+    'whitening_mat_inv.npy', 'similar_templates.npy', 'pc_feature_spike_ids.npy',
+    'template_feature_ind.npy', 'template_feature_spike_ids.npy',
+)
+
+
+class _LazyAttribute(object):
+    """Descriptor loading a data attribute of a model on first access."""
+
+    def __init__(self, name, init):
+        self.name = name
+        self.init = init
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        logger.debug("Lazily loading `%s`.", self.name)
+        # The init method sets the attribute in the instance dictionary, which then takes
+        # precedence over this non-data descriptor. Optional attributes that are not set by an
+        # init method that has already run raise an AttributeError.
+        obj._run_init(self.init)
+        try:
+            return obj.__dict__[self.name]
+        except KeyError:
+            raise AttributeError(self.name)
+
+
+def _declare_lazy_attributes(cls):
+    """Class decorator creating a lazy descriptor for every attribute in `_lazy_attributes`."""
+    for init, names in cls._lazy_attributes:
+        for name in names:
+            setattr(cls, name, _LazyAttribute(name, init))
+    return cls
 
+
+@_declare_lazy_attributes
 class TemplateModel(object):
     """Object holding all data of a KiloSort/phy dataset.
 
@@ -298,6 +553,32 @@ class TemplateModel(object):
         Number of channels in the dat file
     sample_rate : float
         Sampling rate of the data file.
+    lazy : bool
+        Whether to load the data files on first access instead of in the constructor.
+    cache_dir : str or Path
+        Directory, relative to dir_path or absolute, of the on-disk cache of derived data. The
+        cache is disabled if None (default).
+    io_threads : int
+        Number of threads used to read the data files concurrently when loading the dataset,
+        and to extract waveforms in `save_spikes_subset_waveforms()`. The files are read
+        sequentially if 0.
+    spike_clusters_journal : bool
+        Whether `save_spike_clusters()` appends the changes to a journal next to
+        spike_clusters.npy instead of rewriting the whole file. The journal is merged into
+        spike_clusters.npy when the model is closed.
+    journal_compaction_ratio : float
+        Fraction of the number of spikes above which the journal is merged into
+        spike_clusters.npy.
+    waveform_cache_size : int
+        Maximum size, in bytes, of the in-memory cache of the waveforms returned by
+        `get_waveforms()`. The cache is disabled if 0 (default).
+    chunk_cache_size : int
+        Maximum size, in bytes, of the in-memory cache of the decompressed chunks of mtscomp
+        raw data files, shared by all files of the dataset. If 0 (default), the chunks are cached
+        by the mtscomp readers.
+    template_store : bool
+        Whether to unwhiten all templates once and keep them in a memmapped file in the cache
+        directory (or in memory if the cache is disabled).
 
     """
 
@@ -308,6 +589,64 @@ class TemplateModel(object):
     channels."""
     amplitude_threshold = 0
 
+    """Whether the data attributes are loaded on first access instead of in the constructor."""
+    lazy = False
+
+    """Directory, relative to dir_path, of the on-disk cache of derived data (None to disable)."""
+    cache_dir = None
+
+    """Number of threads reading the data files concurrently in the constructor (0 to disable)."""
+    io_threads = 0
+
+    """Whether to save the changes of the spike clusters in an append-only journal instead of
+    rewriting the whole spike_clusters.npy file."""
+    spike_clusters_journal = False
+
+    """The journal is merged into spike_clusters.npy when it contains more changes than this
+    fraction of the number of spikes."""
+    journal_compaction_ratio = .1
+
+    """Whether to unwhiten all templates once and keep them in a memmapped float32 file."""
+    template_store = False
+
+    # Whether this model appended changes to the spike clusters journal since the last compaction.
+    _journal_dirty = False
+
+    """Maximum size, in bytes, of the in-memory cache of spike waveforms (0 to disable)."""
+    waveform_cache_size = 0
+
+    """Maximum size, in bytes, of the in-memory cache of decompressed raw data chunks (0 to use
+    the cache of the mtscomp readers)."""
+    chunk_cache_size = 0
+
+    _saved_spike_clusters = None
+
+    # Data attributes grouped by the method loading them, in loading order.
+    _lazy_attributes = (
+        ('_init_spikes', ('spike_samples', 'spike_times', 'n_spikes')),
+        ('_init_amplitudes', ('amplitudes',)),
+        ('_init_spike_templates', ('spike_templates', 'template_ids')),
+        ('_init_spike_clusters', ('spike_clusters', 'cluster_ids')),
+        ('_init_spike_reorder', ('spike_times_reordered',)),
+        ('_init_channels', ('channel_mapping', 'n_channels')),
+        ('_init_channel_positions', ('channel_positions',)),
+        ('_init_channel_shanks', ('channel_shanks',)),
+        ('_init_channel_probes', ('channel_probes', 'probes', 'n_probes')),
+        ('_init_templates', (
+            'sparse_templates', 'n_templates', 'n_samples_waveforms', 'n_channels_loc')),
+        ('_init_template_clusters', ('template_clusters',)),
+        ('_init_spike_channel_ranges', ('spike_channel_ranges',)),
+        ('_init_clusters', ('merge_map', 'nan_idx', 'sparse_clusters', 'n_clusters')),
+        ('_init_spike_waveforms', ('spike_waveforms',)),
+        ('_init_whitening', ('wm', 'wmi')),
+        ('_init_similar_templates', ('similar_templates',)),
+        ('_init_traces', ('traces', 'duration')),
+        ('_init_features', ('sparse_features', 'features', 'n_features_per_channel')),
+        ('_init_template_features', ('sparse_template_features', 'template_features')),
+        ('_init_spike_attributes', ('spike_attributes',)),
+        ('_init_metadata', ('metadata',)),
+    )
+
     def __init__(self, **kwargs):
         # Default empty values.
         self.dat_path = []
@@ -336,6 +675,31 @@ class TemplateModel(object):
         assert self.sample_rate > 0
         self.offset = getattr(self, 'offset', 0)
 
+        # On-disk cache of derived data, invalidated when the source files change.
+        self._cache = DiskCache(self.dir_path / self.cache_dir) if self.cache_dir else None
+
+        # Arrays being read concurrently, as futures, used by _read_array().
+        self._prefetched = {}
+
+        # Init methods of the data attributes that have already run.
+        self._initialized = set()
+
+        # Spike indices of spike_clusters and spike_templates, {name: Bunch(array, index)}.
+        self._spike_indices = {}
+
+        # Best channels of all templates, {(unwhiten, amplitude_threshold): Bunch}.
+        self._best_channels = {}
+        self._channel_neighbors = None
+
+        # Unwhitened templates, computed on first use if template_store is True.
+        self._template_store = None
+
+        # Waveforms returned by get_waveforms(), keyed by spike and channel ids.
+        self.waveform_cache = LRUCache(self.waveform_cache_size)
+
+        # Decompressed chunks of the mtscomp raw data files.
+        self.chunk_cache = LRUCache(self.chunk_cache_size)
+
         self._load_data()
 
     #--------------------------------------------------------------------------
@@ -343,46 +707,106 @@ class TemplateModel(object):
     #--------------------------------------------------------------------------
 
     def _load_data(self):
-        """Load all data."""
-        # Spikes
+        """Load all data, unless the model is lazy in which case every attribute is loaded
+        on first access."""
+        if self.lazy:
+            return
+        if not self.io_threads:
+            for init, _ in self._lazy_attributes:
+                self._run_init(init)
+            return
+        # Read all arrays concurrently, while the loading methods consume and check them in the
+        # main thread.
+        with ThreadPoolExecutor(max_workers=self.io_threads) as executor:
+            self._prefetch_arrays(executor)
+            try:
+                for init, _ in self._lazy_attributes:
+                    self._run_init(init)
+            finally:
+                self._prefetched = {}
+
+    def __setattr__(self, name, value):
+        if name in ('spike_clusters', 'spike_templates'):
+            # Assigning the array, even the same one after in-place changes, invalidates its
+            # spike index.
+            self.__dict__.get('_spike_indices', {}).pop(name[len('spike_'):], None)
+        super(TemplateModel, self).__setattr__(name, value)
+
+    def _run_init(self, init):
+        """Run an init method once, without overwriting the attributes that have already been
+        set on the model."""
+        if init in self._initialized:
+            return
+        names = dict(self._lazy_attributes)[init]
+        existing = {name: self.__dict__[name] for name in names if name in self.__dict__}
+        getattr(self, init)()
+        # NOTE: an init method that raises runs again, and raises again, on the next access.
+        self._initialized.add(init)
+        self.__dict__.update(existing)
+
+    def _prefetch_arrays(self, executor):
+        """Submit the reading of the arrays that will be loaded in memory to a thread pool."""
+        paths = sorted(set(
+            path for pattern in PREFETCHED_FILES for path in self.dir_path.glob(pattern)))
+        # Read the largest files first.
+        paths = sorted(paths, key=lambda path: path.stat().st_size, reverse=True)
+        logger.debug("Reading %d files with %d threads.", len(paths), self.io_threads)
+        self._prefetched = {path: executor.submit(read_array, path) for path in paths}
+
+    def _init_spikes(self):
         self.spike_samples, self.spike_times = self._load_spike_samples()
-        ns, = self.n_spikes, = self.spike_times.shape
+        self.n_spikes, = self.spike_times.shape
 
         # Make sure the spike times are increasing.
         if not np.all(np.diff(self.spike_times) >= 0):
             raise ValueError("The spike times must be increasing.")
 
+    def _init_amplitudes(self):
         # Spike amplitudes.
         self.amplitudes = self._load_amplitudes()
         if self.amplitudes is not None:
-            assert self.amplitudes.shape == (ns,)
+            assert self.amplitudes.shape == (self.n_spikes,)
 
+    def _init_spike_templates(self):
         # Spike templates.
         self.spike_templates = self._load_spike_templates()
-        assert self.spike_templates.shape == (ns,)
-        
+        assert self.spike_templates.shape == (self.n_spikes,)
+
         # Unique template ids.
-        self.template_ids = np.unique(self.spike_templates)
+        self.template_ids = self._cached(
+            'template_ids', ('spike_templates',), lambda: np.unique(self.spike_templates))
+
+    def _init_spike_clusters(self):
+        if 'spike_clusters' in self.__dict__:
+            # Spike clusters set before being loaded.
+            self.cluster_ids = np.unique(self.spike_clusters)
+            return
 
         # Spike clusters.
         self.spike_clusters = self._load_spike_clusters()
-        assert self.spike_clusters.shape == (ns,)
+        assert self.spike_clusters.shape == (self.n_spikes,)
 
         # Unique cluster ids.
-        self.cluster_ids = np.unique(self.spike_clusters)
+        self.cluster_ids = self._cached(
+            'cluster_ids', ('spike_clusters', 'spike_clusters_journal'),
+            lambda: np.unique(self.spike_clusters))
 
+    def _init_spike_reorder(self):
         # Spike reordering.
         self.spike_times_reordered = self._load_spike_reorder()
         if self.spike_times_reordered is not None:
-            assert self.spike_times_reordered.shape == (ns,)
+            assert self.spike_times_reordered.shape == (self.n_spikes,)
 
+    def _init_channels(self):
         # Channels.
         self.channel_mapping = self._load_channel_map()
-        self.n_channels = nc = self.channel_mapping.shape[0]
+        self.n_channels = self.channel_mapping.shape[0]
         if self.n_channels_dat:
             assert np.all(self.channel_mapping <= self.n_channels_dat - 1)
 
+    def _init_channel_positions(self):
         # Channel positions.
+        nc = self.n_channels
         self.channel_positions = self._load_channel_positions()
         assert self.channel_positions.shape == (nc, 2)
         if not _all_positions_distinct(self.channel_positions):  # pragma: no cover
@@ -390,16 +814,19 @@ class TemplateModel(object):
                 "Some channels are on the same position, please check the channel positions file.")
             self.channel_positions = linear_positions(nc)
 
+    def _init_channel_shanks(self):
         # Channel shanks.
         self.channel_shanks = self._load_channel_shanks()
-        assert self.channel_shanks.shape == (nc,)
+        assert self.channel_shanks.shape == (self.n_channels,)
 
+    def _init_channel_probes(self):
         # Channel probes.
         self.channel_probes = self._load_channel_probes()
-        assert self.channel_probes.shape == (nc,)
+        assert self.channel_probes.shape == (self.n_channels,)
         self.probes = np.unique(self.channel_probes)
         self.n_probes = len(self.probes)
 
+    def _init_templates(self):
         # Templates.
         self.sparse_templates = self._load_templates()
         if self.sparse_templates is not None:
@@ -412,17 +839,27 @@ class TemplateModel(object):
             self.n_samples_waveforms = 0
             self.n_channels_loc = 0
 
+    def _init_template_clusters(self):
         # Template clusters
         self.template_clusters = self._load_template_clusters()
 
+    def _init_spike_channel_ranges(self):
         # Spike channel ranges
         self.spike_channel_ranges = self._load_spike_channel_ranges()
-        
+
+    def _init_clusters(self):
         # Clusters waveforms
         if not np.all(self.spike_clusters == self.spike_templates) and \
                 self.sparse_templates.cols is None:
-            self.merge_map, self.nan_idx = self.get_merge_map()
-            self.sparse_clusters = self.cluster_waveforms()
+            self.merge_map, self.nan_idx = self._cached(
+                'merge_map', ('spike_templates', 'spike_clusters', 'spike_clusters_journal'),
+                self.get_merge_map)
+            self.sparse_clusters = self._cached(
+                'cluster_waveforms', (
+                    'spike_templates', 'spike_clusters', 'spike_clusters_journal', 'templates',
+                    'channel_positions', 'channel_shanks'),
+                self.cluster_waveforms, n_closest_channels=self.n_closest_channels,
+                amplitude_threshold=self.amplitude_threshold)
             self.n_clusters = self.spike_clusters.max() + 1
         else:
             self.merge_map = {}
@@ -430,27 +867,33 @@ class TemplateModel(object):
             self.sparse_clusters = self.sparse_templates
             self.n_clusters = self.spike_templates.max() + 1
 
+    def _init_spike_waveforms(self):
         # Spike waveforms (optional, otherwise fetched from raw data as needed).
         self.spike_waveforms = self._load_spike_waveforms()
 
+    def _init_whitening(self):
         # Whitening.
+        nc = self.n_channels
         try:
-            self.wm = self._load_wm()
+            wm = self._load_wm()
         except IOError:
             logger.debug("Whitening matrix file not found.")
-            self.wm = np.eye(nc)
-        assert self.wm.shape == (nc, nc)
+            wm = np.eye(nc)
+        assert wm.shape == (nc, nc)
         try:
-            self.wmi = self._load_wmi()
+            wmi = self._load_wmi()
         except IOError:
             logger.debug("Whitening matrix inverse file not found, computing it.")
-            self.wmi = self._compute_wmi(self.wm)
-        assert self.wmi.shape == (nc, nc)
+            wmi = self._compute_wmi(wm)
+        assert wmi.shape == (nc, nc)
+        self.wm, self.wmi = wm, wmi
 
+    def _init_similar_templates(self):
         # Similar templates.
         self.similar_templates = self._load_similar_templates()
         assert self.similar_templates.shape == (self.n_templates, self.n_templates)
 
+    def _init_traces(self):
         # Traces and duration.
         self.traces = self._load_traces(self.channel_mapping)
         if self.traces is not None:
@@ -462,23 +905,44 @@ class TemplateModel(object):
                 "There are %d/%d spikes after the end of the recording.",
                 np.sum(self.spike_times > self.duration), self.n_spikes)
 
+    def _init_features(self):
         # Features.
         self.sparse_features = self._load_features()
         self.features = self.sparse_features.data if self.sparse_features else None
         if self.sparse_features is not None:
             self.n_features_per_channel = self.sparse_features.data.shape[2]
 
+    def _init_template_features(self):
         # Template features.
         self.sparse_template_features = self._load_template_features()
         self.template_features = (
             self.sparse_template_features.data if self.sparse_template_features else None)
 
+    def _init_spike_attributes(self):
         # Spike attributes.
         self.spike_attributes = self._load_spike_attributes()
 
+    def _init_metadata(self):
         # Metadata.
         self.metadata = self._load_metadata()
 
+    def _cached(self, name, sources, compute, **params):
+        """Return the output of `compute()`, loaded from the on-disk cache if it is enabled and
+        if the source files have not changed.
+
+        `sources` is a list of keys of DATA_FILES, and `params` contains other parameters that
+        the output depends on.
+
+        """
+        if self._cache is None:
+            return compute()
+        return self._cache.get(name, self._cache_key(sources, **params), compute)
+
+    def _cache_key(self, sources, **params):
+        """Return the fingerprint of some DATA_FILES and parameters."""
+        paths = [self._find_path(*DATA_FILES[source], mandatory=False) for source in sources]
+        return file_fingerprint(paths, **params)
+
     def _find_path(self, *names, multiple_ok=True, mandatory=True):
         full_paths = list(l[0] for l in [list(self.dir_path.glob(name)) for name in names] if l)
         path = _find_first_existing_path(*full_paths, multiple_ok=multiple_ok)
@@ -491,6 +955,9 @@ class TemplateModel(object):
     def _read_array(self, path, mmap_mode=None):
         if not path:
             raise IOError()
+        future = self._prefetched.pop(Path(path), None) if mmap_mode is None else None
+        if future is not None:
+            return future.result().squeeze()
         return read_array(path, mmap_mode=mmap_mode).squeeze()
 
     def _write_array(self, path, arr):
@@ -549,7 +1016,7 @@ class TemplateModel(object):
         return out
 
     def _load_channel_positions(self):
-        path = self._find_path('channel_positions.npy', 'channels.localCoordinates*.npy')
+        path = self._find_path(*DATA_FILES['channel_positions'])
         out = self._read_array(path)
         out = np.atleast_2d(out)
         assert out.ndim == 2
@@ -567,7 +1034,7 @@ class TemplateModel(object):
 
     def _load_channel_shanks(self):
         try:
-            path = self._find_path('channel_shanks.npy', 'channels.shanks*.npy')
+            path = self._find_path(*DATA_FILES['channel_shanks'])
             out = self._read_array(path).reshape((-1,))
             assert out.ndim == 1
             return out
@@ -585,7 +1052,8 @@ class TemplateModel(object):
         # self.dat_path could be any object accepted by get_ephys_reader().
         traces = get_ephys_reader(
             self.dat_path, n_channels_dat=n, dtype=self.dtype, offset=self.offset,
-            sample_rate=self.sample_rate)
+            sample_rate=self.sample_rate,
+            chunk_cache=self.chunk_cache if self.chunk_cache_size else None)
         if traces is not None:
             traces = traces[:, channel_map]  # lazy permutation on the channel axis
         return traces
@@ -600,7 +1068,7 @@ class TemplateModel(object):
             return
 
     def _load_spike_templates(self):
-        path = self._find_path('spike_templates.npy', 'spikes.templates*.npy')
+        path = self._find_path(*DATA_FILES['spike_templates'])
         out = self._read_array(path)
         if out.dtype in (np.float32, np.float64):  # pragma: no cover
             out = out.astype(np.int32)
@@ -614,7 +1082,7 @@ class TemplateModel(object):
 
     def _load_spike_clusters(self):
         path = self._find_path(
-            'spike_clusters.npy', 'spikes.clusters*.npy', multiple_ok=False, mandatory=False)
+            *DATA_FILES['spike_clusters'], multiple_ok=False, mandatory=False)
         if path is None:
             # Create spike_clusters file if it doesn't exist.
             tmp_path = self._find_path('spike_templates.npy', 'spikes.clusters*.npy')
@@ -626,6 +1094,10 @@ class TemplateModel(object):
         # NOTE: we make a copy in memory so that we can update this array
         # during manual clustering.
         out = self._read_array(path).astype(np.int32)
+        # Replay the changes saved in the journal since the last full save.
+        _replay_spike_clusters_journal(out, path)
+        # Last saved spike clusters, used to find the changes to write in the journal.
+        self._saved_spike_clusters = out.copy()
         uc = np.unique(out)
         if np.max(uc) - np.min(uc) + 1 != uc.size:
             logger.warning(
@@ -699,15 +1171,19 @@ class TemplateModel(object):
 
         # Sparse structure: regular array with col indices.
         try:
-            path = self._find_path(
-                'templates.npy', 'templates.waveforms.npy', 'templates.waveforms.*.npy')
-            data = self._read_array(path, mmap_mode='r+')
-            data = np.atleast_3d(data)            
+            path = self._find_path(*DATA_FILES['templates'])
+            # NOTE: copy-on-write memmap, so that the empty templates can be replaced in memory
+            # without modifying the file, and without loading the other templates in memory.
+            data = self._read_array(path, mmap_mode='c')
+            data = np.atleast_3d(data)
             assert data.ndim == 3
             assert data.dtype in (np.float32, np.float64)
-            # WARNING: this will load the full array in memory, might cause memory problems
-            empty_templates = np.all(np.all(np.isnan(data), axis=1), axis=1)
-            data[empty_templates, ...] = 0
+            # Scan the templates by chunks to find those that are all nan.
+            empty_templates = self._cached(
+                'empty_templates', ('templates',), lambda: _find_empty_rows(data))
+            if np.any(empty_templates):
+                logger.debug("Replacing %d empty templates by zero.", np.sum(empty_templates))
+                data[empty_templates, ...] = 0
             n_templates, n_samples, n_channels_loc = data.shape
         except IOError:
             return
@@ -718,7 +1194,7 @@ class TemplateModel(object):
             # That means templates.npy is considered as a dense array.
             # Proper fix would be to save templates.npy as a true sparse array, with proper
             # template_ind.npy (without an s).
-            path = self._find_path('template_ind.npy', 'templates.waveformsChannels*.npy')
+            path = self._find_path(*DATA_FILES['template_ind'])
             cols = self._read_array(path)
             if cols.ndim != 2:  # pragma: no cover
                 cols = np.atleast_2d(cols).T
@@ -845,50 +1321,205 @@ class TemplateModel(object):
     # Internal data access methods
     #--------------------------------------------------------------------------
 
-    def _find_best_channels(self, template, amplitude_threshold=None):
-        """Find the best channels for a given template."""
-        # Compute the template amplitude on each channel.
-        assert template.ndim == 2  # shape: (n_samples, n_channels)
-        amplitude = template.max(axis=0) - template.min(axis=0)
-        assert not np.all(np.isnan(amplitude)), "Template is all NaN!"
-        assert amplitude.ndim == 1  # shape: (n_channels,)
-        # Find the peak channel.
-        best_channel = np.argmax(amplitude)
-        max_amp = amplitude[best_channel]
-        # Find the channels X% peak.
+    def _template_amplitudes(self, unwhiten=True):
+        """Return the (n_templates, n_channels) peak-to-peak amplitudes of the dense templates,
+        computed block by block."""
+        data = self.sparse_templates.data
+        amplitudes = np.empty((self.n_templates, data.shape[2]), dtype=np.float32)
+        i = 0
+        for block in _iter_row_chunks(data):
+            n, ns, nc = block.shape
+            if unwhiten:
+                block = self._unwhiten(block.reshape((n * ns, nc))).astype(np.float32)
+                block = block.reshape((n, ns, nc))
+            amplitudes[i:i + n] = block.max(axis=1) - block.min(axis=1)
+            i += n
+        return amplitudes
+
+    def _unwhiten_batch(self, data, rows, cols):
+        """Unwhiten several templates at once.
+
+        `data` is a (n_templates, n_samples, n_rows) array and `rows` and `cols` are
+        (n_templates, n_rows) and (n_templates, n_cols) arrays with the channels of the input and
+        output columns. Padding channels (-1) must correspond to zero columns in the input.
+
+        """
+        rows, cols = np.maximum(rows, 0), np.maximum(cols, 0)
+        mat = self.wmi[rows[:, :, np.newaxis], cols[:, np.newaxis, :]]
+        out = np.matmul(data, mat) * getattr(self, 'template_scaling', 1.0)
+        return out.astype(np.float32)
+
+    def _sparse_template_columns(self, data, cols):
+        """Return the columns of sparse templates with some signal and a channel."""
+        template_max = np.abs(data).max(axis=1)
+        valid = template_max > template_max.max(axis=1)[:, np.newaxis] * 1e-6
+        valid &= cols != -1
+        return valid
+
+    def _sparse_template_channels(self, unwhiten=True):
+        """Return the best channels of all sparse templates, in the same order as
+        `_get_template_sparse()`, and their columns in the sparse templates array."""
+        data, cols = self.sparse_templates.data, self.sparse_templates.cols
+        channel_ids = np.full(cols.shape, -1, dtype=np.int64)
+        columns = np.full(cols.shape, -1, dtype=np.int64)
+        n_channels = np.zeros(self.n_templates, dtype=np.int64)
+        i = 0
+        for block in _iter_row_chunks(data):
+            n = block.shape[0]
+            rows = np.arange(n)[:, np.newaxis]
+            block_cols = cols[i:i + n].astype(np.int64)
+            valid = self._sparse_template_columns(block, block_cols)
+            block = np.where(valid[:, np.newaxis, :], block, 0)
+            if unwhiten:
+                block = self._unwhiten_batch(block, block_cols, block_cols)
+            amplitude = block.max(axis=1) - block.min(axis=1)
+            order = _argsort_decreasing(amplitude, valid)
+            valid = valid[rows, order]
+            channel_ids[i:i + n] = np.where(valid, block_cols[rows, order], -1)
+            columns[i:i + n] = np.where(valid, order, -1)
+            n_channels[i:i + n] = valid.sum(axis=1)
+            i += n
+        return Bunch(channel_ids=channel_ids, columns=columns, n_channels=n_channels)
+
+    def get_best_channels(self, unwhiten=True, amplitude_threshold=None):
+        """Return the best channels of all templates, computed at once and cached.
+
+        Return a Bunch with `channel_ids`, a (n_templates, n) array with the best channels of
+        every template ordered by decreasing amplitude and padded with -1, and `n_channels`,
+        the number of best channels of every template. For dense templates, the Bunch also
+        contains `amplitude` and `best_channel`, see `_best_channels_from_amplitudes()`.
+
+        """
         amplitude_threshold = (
             amplitude_threshold if amplitude_threshold is not None else self.amplitude_threshold)
-        peak_channels = np.nonzero(amplitude >= amplitude_threshold * max_amp)[0]
-        # Find N closest channels.
-        close_channels = get_closest_channels(
-            self.channel_positions, best_channel, self.n_closest_channels)
-        assert best_channel in close_channels
-        # Restrict to the channels belonging to the best channel's shank.
-        if self.channel_shanks is not None:
-            shank = self.channel_shanks[best_channel]  # shank of best channel
-            channels_on_shank = np.nonzero(self.channel_shanks == shank)[0]
-            close_channels = np.intersect1d(close_channels, channels_on_shank)
-        # Keep the intersection.
-        channel_ids = np.intersect1d(peak_channels, close_channels)
-        # Order the channels by decreasing amplitude.
-        order = np.argsort(amplitude[channel_ids])[::-1]
-        channel_ids = channel_ids[order]
-        amplitude = amplitude[order]
-        assert best_channel in channel_ids
-        assert amplitude.shape == (len(channel_ids),)
-        return channel_ids, amplitude, best_channel
-
-    def _template_n_channels(self, template_id, n_channels):
-        """Return the n best channels for a given template, filling with -1s if there isn't
-        enough best channels for that template."""
+        key = (unwhiten, amplitude_threshold)
+        if key in self._best_channels:
+            return self._best_channels[key]
+        if self.sparse_templates.cols is not None:
+            out = self._sparse_template_channels(unwhiten=unwhiten)
+        else:
+            if self._channel_neighbors is None:
+                self._channel_neighbors = get_channel_neighbors(
+                    self.channel_positions, self.n_closest_channels,
+                    channel_shanks=self.channel_shanks)
+            out = _best_channels_from_amplitudes(
+                self._template_amplitudes(unwhiten=unwhiten), self._channel_neighbors,
+                amplitude_threshold=amplitude_threshold)
+        self._best_channels[key] = out
+        return out
+
+    def _compute_template_store(self, data):
+        """Unwhiten all templates into a (n_templates, n_samples, n_cols) array, with the
+        columns of every template reordered to have its best channels first.
+
+        Return the channels and the amplitudes of all columns, and the number of best channels.
+
+        """
+        best = self.get_best_channels()
+        templates, cols = self.sparse_templates.data, self.sparse_templates.cols
+        n_cols = templates.shape[2]
+        # Position of the best channels in the columns of the templates array.
+        first = best.columns if cols is not None else best.channel_ids
+        channel_ids = np.full((self.n_templates, n_cols), -1, dtype=np.int64)
+        amplitude = np.zeros((self.n_templates, n_cols), dtype=np.float32)
+        i = 0
+        for block in _iter_row_chunks(templates):
+            n = block.shape[0]
+            rows = np.arange(n)[:, np.newaxis]
+            if cols is not None:
+                block_cols = cols[i:i + n].astype(np.int64)
+                valid = self._sparse_template_columns(block, block_cols)
+                block = np.where(valid[:, np.newaxis, :], block, 0)
+                block_cols = np.where(valid, block_cols, -1)
+            else:
+                block_cols = np.broadcast_to(np.arange(n_cols), (n, n_cols))
+            block = self._unwhiten_batch(block, block_cols, block_cols)
+            # Best channels first, by decreasing amplitude, then the other columns.
+            rank = np.tile(n_cols + np.arange(n_cols), (n, 1))
+            r, j = np.nonzero(first[i:i + n] >= 0)
+            rank[r, first[i + r, j]] = j
+            perm = np.argsort(rank, axis=1)
+            block = np.take_along_axis(block, perm[:, np.newaxis, :], axis=2)
+            data[i:i + n] = block
+            channel_ids[i:i + n] = block_cols[rows, perm]
+            amplitude[i:i + n] = block.max(axis=1) - block.min(axis=1)
+            i += n
+        return Bunch(channel_ids=channel_ids, amplitude=amplitude, n_channels=best.n_channels)
+
+    def _use_template_store(self, unwhiten, amplitude_threshold):
+        """Whether templates can be read from the template store."""
+        return bool(self.template_store and unwhiten and
+                    amplitude_threshold in (None, self.amplitude_threshold))
+
+    def get_template_store(self):
+        """Return the unwhitened templates, computed once and saved in the cache directory.
+
+        Return a Bunch with `data`, a (n_templates, n_samples, n_cols) float32 array (memmapped
+        if the cache is enabled), and the (n_templates, n_cols) arrays `channel_ids` and
+        `amplitude`. The columns of every template are ordered with the `n_channels` best
+        channels first, by decreasing amplitude. For dense templates, the other columns contain
+        the other channels by increasing id. For sparse templates, unused columns have a
+        channel -1 and are zero.
+
+        """
+        if self._template_store is not None:
+            return self._template_store
+        shape = (self.n_templates, self.n_samples_waveforms, self.sparse_templates.data.shape[2])
+        if self._cache is None:
+            data = np.zeros(shape, dtype=np.float32)
+            out = self._compute_template_store(data)
+            out.data = data
+        else:
+            path = self._cache.cache_dir / 'templates_unwhitened.npy'
+            key = self._cache_key(
+                ('templates', 'template_ind', 'channel_positions', 'channel_shanks'),
+                n_closest_channels=self.n_closest_channels,
+                amplitude_threshold=self.amplitude_threshold,
+                template_scaling=getattr(self, 'template_scaling', 1.0),
+                wmi=_array_checksum(self.wmi))
+            out = self._cache.load('template_store', key)
+            if out is None or not path.exists():
+                logger.debug("Saving the unwhitened templates to `%s`.", path)
+                ensure_dir_exists(self._cache.cache_dir)
+                data = open_memmap(str(path), mode='w+', dtype=np.float32, shape=shape)
+                out = self._compute_template_store(data)
+                data.flush()
+                del data
+                self._cache.save('template_store', key, out)
+            out = Bunch(out)
+            out.data = read_array(path, mmap_mode='r')
+        self._template_store = out
+        return out
+
+    def _template_n_channels(self, n_channels):
+        """Return a (n_templates, n_channels) array with the n best channels of every template,
+        filled with -1s if there isn't enough best channels, or if the template has no
+        spikes."""
         assert n_channels > 0
-        if template_id not in self.template_ids:
-            return [-1] * n_channels
-        template = self.get_template(template_id)
-        channel_ids = list(template.channel_ids[:n_channels])
-        if len(channel_ids) < n_channels:
-            channel_ids += [-1] * (n_channels - len(channel_ids))
-        return channel_ids
+        out = np.full((self.n_templates, n_channels), -1, dtype=np.int32)
+        channel_ids = self.get_best_channels().channel_ids[:, :n_channels]
+        out[:, :channel_ids.shape[1]] = channel_ids
+        out[~np.isin(np.arange(self.n_templates), self.template_ids)] = -1
+        return out
+
+    def _get_template_store(self, template_id):
+        """Return data for one template from the template store, as `_get_template_dense()` or
+        `_get_template_sparse()` would."""
+        store = self.get_template_store()
+        n = store.n_channels[template_id]
+        amplitude = np.array(store.amplitude[template_id, :n])
+        channel_ids = np.array(store.channel_ids[template_id, :n])
+        if self.sparse_templates.cols is not None:
+            # The amplitudes of sparse templates are in the order of the template columns.
+            columns = self.get_best_channels().columns[template_id, :n]
+            amplitude = amplitude[np.argsort(columns)]
+            channel_ids = channel_ids.astype(np.uint32)
+        return Bunch(
+            template=np.array(store.data[template_id, :, :n]),
+            amplitude=amplitude,
+            best_channel=channel_ids[0],
+            channel_ids=channel_ids,
+        )
 
     def _get_template_dense(self, template_id, channel_ids=None, amplitude_threshold=None,
                             unwhiten=True):
@@ -898,9 +1529,12 @@ class TemplateModel(object):
         template_w = self.sparse_templates.data[template_id, ...]
         template = self._unwhiten(template_w).astype(np.float32) if unwhiten else template_w
         assert template.ndim == 2
-        channel_ids_, amplitude, best_channel = self._find_best_channels(
-            template, amplitude_threshold=amplitude_threshold)
-        channel_ids = channel_ids if channel_ids is not None else channel_ids_
+        best = self.get_best_channels(unwhiten=unwhiten, amplitude_threshold=amplitude_threshold)
+        n = best.n_channels[template_id]
+        amplitude = best.amplitude[template_id, :n]
+        best_channel = best.best_channel[template_id]
+        channel_ids = channel_ids if channel_ids is not None else \
+            best.channel_ids[template_id, :n]
         template = template[:, channel_ids]
         assert template.ndim == 2
         assert template.shape[1] == channel_ids.shape[0]
@@ -950,18 +1584,36 @@ class TemplateModel(object):
         )
         return out
 
-    def get_merge_map(self):
-        """"Gets the maps of merges and splits between spikes.clusters and spikes.templates"""
-        inverse_mapping_dict = {key: [] for key in range(np.max(self.spike_clusters) + 1)}
-        for temp in np.unique(self.spike_templates):
-            idx = np.where(self.spike_templates == temp)[0]
-            new_idx = self.spike_clusters[idx]
-            mapping = np.unique(new_idx)
-            for n in mapping:
-                inverse_mapping_dict[n].append(temp)
+    def get_cluster_template_counts(self, cluster_ids=None):
+        """Return the contingency table between clusters and templates, as a sparse
+        (n_clusters, n_templates) CSR matrix with the number of spikes of every template
+        in every cluster.
+
+        If `cluster_ids` is specified, return a (len(cluster_ids), n_templates) matrix for these
+        clusters only, computed from the spike index in time proportional to their sizes.
+
+        """
+        if cluster_ids is None:
+            return _count_pairs(self.spike_clusters, self.spike_templates)
+        index = self.get_spike_index('clusters')
+        spike_ids = [index.spikes([cluster_id]) for cluster_id in cluster_ids]
+        rows = np.repeat(np.arange(len(spike_ids)), [len(s) for s in spike_ids])
+        templates = self.spike_templates[np.concatenate(spike_ids or [[]]).astype(np.int64)]
+        return _count_pairs(rows, templates, shape=(len(spike_ids), self.n_templates))
 
-        nan_idx = np.array([idx for idx, val in inverse_mapping_dict.items() if len(val) == 0])
+    def get_merge_map(self, counts=None):
+        """"Gets the maps of merges and splits between spikes.clusters and spikes.templates
 
+        The optional `counts` argument is the contingency table returned by
+        `get_cluster_template_counts()`, computed if not given.
+
+        """
+        counts = counts if counts is not None else self.get_cluster_template_counts()
+        indptr, indices = counts.indptr, counts.indices
+        inverse_mapping_dict = {
+            cluster: indices[indptr[cluster]:indptr[cluster + 1]].tolist()
+            for cluster in range(counts.shape[0])}
+        nan_idx = np.nonzero(np.diff(indptr) == 0)[0]
         return inverse_mapping_dict, nan_idx
 
     #--------------------------------------------------------------------------
@@ -970,6 +1622,8 @@ class TemplateModel(object):
 
     def get_template(self, template_id, channel_ids=None, amplitude_threshold=None, unwhiten=True):
         """Get data about a template."""
+        if channel_ids is None and self._use_template_store(unwhiten, amplitude_threshold):
+            return self._get_template_store(template_id)
         if self.sparse_templates and self.sparse_templates.cols is not None:
             return self._get_template_sparse(template_id, unwhiten=unwhiten)
         else:
@@ -977,31 +1631,113 @@ class TemplateModel(object):
                 template_id, channel_ids=channel_ids, amplitude_threshold=amplitude_threshold,
                 unwhiten=unwhiten)
 
+    def get_templates(self, template_ids, amplitude_threshold=None, unwhiten=True):
+        """Get data about several templates at once.
+
+        Return a Bunch with the following (n_templates, ...) arrays, padded along the channel
+        dimension:
+
+        * `template_ids`
+        * `data`: the templates on their best channels, padded with zeros
+        * `channel_ids`: the best channels, ordered by decreasing amplitude, padded with -1
+        * `amplitude`: the amplitude on the best channels, padded with zeros
+        * `best_channel`
+        * `n_channels`: the number of best channels
+
+        The row `i` of `data[i, :, :n_channels[i]]` is the same as
+        `get_template(template_ids[i]).template`.
+
+        """
+        template_ids = np.asarray(template_ids, dtype=np.int64)
+        best = self.get_best_channels(unwhiten=unwhiten, amplitude_threshold=amplitude_threshold)
+        n_channels = best.n_channels[template_ids]
+        k = max(1, n_channels.max()) if len(template_ids) else 1
+        channel_ids = best.channel_ids[template_ids, :k]
+        padding = channel_ids < 0
+        if self._use_template_store(unwhiten, amplitude_threshold):
+            data = self.get_template_store().data[template_ids, :, :k]
+        elif self.sparse_templates.cols is not None:
+            data = self.sparse_templates.data[template_ids]
+            # Columns of the best channels in the sparse templates array.
+            columns = np.maximum(best.columns[template_ids, :k], 0)
+            if unwhiten:
+                cols = self.sparse_templates.cols[template_ids].astype(np.int64)
+                valid = self._sparse_template_columns(data, cols)
+                data = self._unwhiten_batch(
+                    np.where(valid[:, np.newaxis, :], data, 0), cols, channel_ids)
+            else:
+                data = np.take_along_axis(data, columns[:, np.newaxis, :], axis=2)
+        elif unwhiten:
+            data = self.sparse_templates.data[template_ids]
+            rows = np.broadcast_to(np.arange(data.shape[2]), data.shape[::2])
+            data = self._unwhiten_batch(data, rows, channel_ids)
+        else:
+            data = np.take_along_axis(
+                self.sparse_templates.data[template_ids],
+                np.maximum(channel_ids, 0)[:, np.newaxis, :], axis=2)
+        data = np.where(padding[:, np.newaxis, :], 0, data).astype(np.float32)
+        return Bunch(
+            template_ids=template_ids,
+            data=data,
+            channel_ids=channel_ids,
+            amplitude=data.max(axis=1) - data.min(axis=1),
+            best_channel=channel_ids[:, 0],
+            n_channels=n_channels,
+        )
+
     def get_waveforms(self, spike_ids, channel_ids=None):
-        """Return spike waveforms on specified channels."""
+        """Return spike waveforms on specified channels.
+
+        The waveforms are kept in an LRU cache of `waveform_cache_size` bytes, whose hit and
+        miss counters are available in `waveform_cache.stats()`.
+
+        """
         if self.traces is None and self.spike_waveforms is None:
             return
-        # Create the output array.
-        nsw = self.n_samples_waveforms
         channel_ids = np.arange(self.n_channels) if channel_ids is None else channel_ids
+        if not self.waveform_cache.max_bytes:
+            return self._get_waveforms(spike_ids, channel_ids)
+        # NOTE: the waveforms of a spike do not depend on its cluster, so the cache remains
+        # valid when spike_clusters changes.
+        key = (np.asarray(spike_ids, dtype=np.int64).tobytes(),
+               np.asarray(channel_ids, dtype=np.int64).tobytes())
+        out = self.waveform_cache.get(key)
+        if out is None:
+            out = self._get_waveforms(spike_ids, channel_ids)
+            self.waveform_cache.put(key, out, nbytes=out.nbytes + len(key[0]) + len(key[1]))
+        # Return a copy so that the cached array cannot be modified.
+        return out.copy()
+
+    def _get_waveforms(self, spike_ids, channel_ids):
+        nsw = self.n_samples_waveforms
+        if self.spike_waveforms is None:
+            # Load directly from raw data (slower).
+            spike_samples = self.spike_samples[spike_ids]
+            return extract_waveforms(
+                self.traces, spike_samples, channel_ids, n_samples_waveforms=nsw)
 
-        if self.spike_waveforms is not None:
-            # Load from precomputed spikes.
-            try:
-                return get_spike_waveforms(
+        # Load from precomputed spikes.
+        spike_ids = np.asarray(spike_ids, dtype=np.int64)
+        found = np.isin(spike_ids, self.spike_waveforms.spike_ids)
+        if found.all():
+            return get_spike_waveforms(
                 spike_ids, channel_ids, spike_waveforms=self.spike_waveforms,
                 n_samples_waveforms=nsw)
-            except AssertionError:
-              logger.warning(
-                  "Error when loading waveforms from precomputed waveforms, trying to load the raw data.")
-              spike_samples = self.spike_samples[spike_ids]
-              return extract_waveforms(
-                  self.traces, spike_samples, channel_ids, n_samples_waveforms=nsw)
+        # Some spikes do not have precomputed waveforms: load them from the raw data.
+        out = np.zeros(
+            (len(spike_ids), nsw, len(channel_ids)), dtype=self.spike_waveforms.waveforms.dtype)
+        out[found] = get_spike_waveforms(
+            spike_ids[found], channel_ids, spike_waveforms=self.spike_waveforms,
+            n_samples_waveforms=nsw)
+        missing = spike_ids[~found]
+        if self.traces is not None:
+            out[~found] = extract_waveforms(
+                self.traces, self.spike_samples[missing], channel_ids, n_samples_waveforms=nsw)
         else:
-            # Or load directly from raw data (slower).
-            spike_samples = self.spike_samples[spike_ids]
-            return extract_waveforms(
-                self.traces, spike_samples, channel_ids, n_samples_waveforms=nsw)
+            logger.warning(
+                "%d spikes do not have precomputed waveforms and the raw data is not available.",
+                len(missing))
+        return out
 
     def get_features(self, spike_ids, channel_ids):
         """Return sparse features for given spikes."""
@@ -1140,8 +1876,23 @@ class TemplateModel(object):
             raise NotImplementedError
         # apply the inverse whitening matrix to the template
         templates_wfs = np.zeros_like(sparse.data)  # nt, ns, nc
-        for n in np.arange(n_wav):
-            templates_wfs[n, :, :] = np.matmul(sparse.data[n, :, :], self.wmi)
+        assert templates_wfs.shape[0] == n_wav
+        i = 0
+        if use != 'clusters' and self.template_store:
+            # Put the columns of the unwhitened templates back in the channel order.
+            store = self.get_template_store()
+            scaling = getattr(self, 'template_scaling', 1.0)
+            for block in _iter_row_chunks(store.data):
+                n = block.shape[0]
+                order = np.argsort(store.channel_ids[i:i + n], axis=1)
+                templates_wfs[i:i + n] = np.take_along_axis(
+                    block, order[:, np.newaxis, :], axis=2) / scaling
+                i += n
+        else:
+            for block in _iter_row_chunks(sparse.data):
+                n = block.shape[0]
+                templates_wfs[i:i + n] = np.matmul(block, self.wmi)
+                i += n
 
         # The amplitude on each channel is the positive peak minus the negative
         templates_ch_amps = np.max(templates_wfs, axis=1) - np.min(templates_wfs, axis=1)
@@ -1205,13 +1956,32 @@ class TemplateModel(object):
         st = self.spike_templates[spike_ids]
         return np.bincount(st, minlength=self.n_templates)
 
+    def get_spike_index(self, name='clusters'):
+        """Return the SpikeIndex of `spike_clusters` or `spike_templates`, depending on whether
+        `name` is `clusters` or `templates`.
+
+        The index is built on first use, and rebuilt after the `spike_<name>` attribute is
+        assigned. After in-place changes of `spike_clusters`, either use
+        `update_spike_clusters()`, which updates the index incrementally, or assign the array
+        again with `model.spike_clusters = model.spike_clusters`.
+
+        """
+        assert name in ('clusters', 'templates')
+        arr = getattr(self, 'spike_%s' % name)
+        previous = self._spike_indices.get(name)
+        if previous is not None and previous.array is arr:
+            return previous.index
+        logger.debug("Building the spike index of spike_%s.", name)
+        self._spike_indices[name] = Bunch(array=arr, index=SpikeIndex(arr))
+        return self._spike_indices[name].index
+
     def get_template_spikes(self, template_id):
         """Return the spike ids that belong to a given template."""
-        return _spikes_in_clusters(self.spike_templates, [template_id])
+        return self.get_spike_index('templates').spikes([template_id])
 
     def get_cluster_spikes(self, cluster_id):
         """Return the spike ids that belong to a given template."""
-        return _spikes_in_clusters(self.spike_clusters, [cluster_id])
+        return self.get_spike_index('clusters').spikes([cluster_id])
 
     def get_template_channels(self, template_id):
         """Return the most relevant channels of a template."""
@@ -1235,17 +2005,16 @@ class TemplateModel(object):
         best_template = np.argmax(count)
         template_ids = np.nonzero(count)[0]
         count = count[template_ids]
-        # Get local channels of the best template for the given cluster.
-        template = self.get_template(best_template, unwhiten=unwhiten)
-        channel_ids = template.channel_ids
         # Get all templates from which this cluster stems from.
-        templates = [self.get_template(template_id, unwhiten=unwhiten)
-                     for template_id in template_ids]
+        templates = self.get_templates(template_ids, unwhiten=unwhiten)
+        # Get local channels of the best template for the given cluster.
+        best = np.nonzero(template_ids == best_template)[0][0]
+        channel_ids = templates.channel_ids[best, :templates.n_channels[best]]
         # Construct the waveforms array.
         ns = self.n_samples_waveforms
         data = np.zeros((len(template_ids), ns, self.n_channels))
-        for i, b in enumerate(templates):
-            data[i][:, b.channel_ids] = b.template
+        i, j = np.nonzero(templates.channel_ids >= 0)
+        data[i, :, templates.channel_ids[i, j]] = templates.data[i, :, j]
         waveforms = data[..., channel_ids]
         assert waveforms.shape == (len(template_ids), ns, len(channel_ids))
         mean_waveforms = np.average(waveforms, axis=0, weights=count)
@@ -1334,19 +2103,130 @@ class TemplateModel(object):
         """
         Computes the cluster waveforms for split and merged clusters
         :return:
+
+        A cluster stemming from a single template has the waveform of that template. The waveform
+        of a merged cluster is the average of the waveforms of its templates, each restricted to
+        its best channels, weighted by their number of spikes in the cluster, and restricted to
+        the best channels of the template with the most spikes (see
+        `get_cluster_mean_waveforms()`). All merged clusters are computed with a single sparse
+        matrix product.
+
         """
+        return Bunch(data=self._cluster_waveforms(self.get_cluster_template_counts()), cols=None)
+
+    def _cluster_waveforms(self, counts):
+        """Return the waveforms of the clusters corresponding to the rows of a cluster/template
+        contingency table."""
         # Only non sparse implementation
-        ns = self.n_samples_waveforms
-        data = np.zeros((np.max(self.cluster_ids) + 1, ns, self.n_channels))
-        for clust, val in self.merge_map.items():
-            if len(val) > 1:
-                mean_waveform = self.get_cluster_mean_waveforms(clust, unwhiten=False)
-                data[clust, :, mean_waveform.channel_ids] = \
-                    np.swapaxes(mean_waveform.mean_waveforms, 0, 1)
-            elif len(val) == 1:
-                data[clust, :, :] = self.sparse_templates.data[val[0], :, :]
+        templates = self.sparse_templates.data
+        _, ns, nc = templates.shape
+        n_clusters = counts.shape[0]
+        n_templates_per_cluster = np.diff(counts.indptr)
+        data = np.zeros((n_clusters, ns, nc))
+
+        # Clusters stemming from a single template.
+        single = np.nonzero(n_templates_per_cluster == 1)[0]
+        data[single] = templates[counts.indices[counts.indptr[single]]]
+
+        # Merged clusters.
+        merged = np.nonzero(n_templates_per_cluster > 1)[0]
+        if not len(merged):
+            return data
+        counts = counts[merged]
+        # Templates involved in merged clusters, restricted to their best channels.
+        used = np.unique(counts.indices)
+        masks = np.zeros((len(used), nc + 1), dtype=bool)
+        # NOTE: the -1 padding of the best channels goes to the last, discarded, column.
+        masks[np.arange(len(used))[:, np.newaxis],
+              self.get_best_channels(unwhiten=False).channel_ids[used]] = True
+        masks = masks[:, :nc]
+        masked = templates[used] * masks[:, np.newaxis, :]
+        # Weighted average of the templates of every merged cluster.
+        counts = counts[:, used]
+        weights = sparse.diags(1. / np.asarray(counts.sum(axis=1)).ravel()) @ counts
+        mean = (weights @ masked.reshape((len(used), -1))).reshape((len(merged), ns, nc))
+        # Restrict every merged cluster to the best channels of its main template.
+        best = np.asarray(counts.argmax(axis=1)).ravel()
+        data[merged] = mean * masks[best][:, np.newaxis, :]
+
+        return data
+
+    def _resize_cluster_waveforms(self, n_clusters):
+        """Resize the cluster waveforms array, with a geometrically growing buffer so that
+        creating new clusters one at a time has an amortized constant cost."""
+        data = self.sparse_clusters.data
+        if n_clusters <= data.shape[0]:
+            self.sparse_clusters = Bunch(data=data[:n_clusters], cols=None)
+            return
+        buffer = getattr(self, '_cluster_waveforms_buffer', None)
+        if buffer is None or data.base is not buffer or n_clusters > buffer.shape[0]:
+            buffer = np.zeros((max(n_clusters, int(1.5 * data.shape[0])),) + data.shape[1:])
+            buffer[:data.shape[0]] = data
+            self._cluster_waveforms_buffer = buffer
+        self.sparse_clusters = Bunch(data=buffer[:n_clusters], cols=None)
+
+    def update_spike_clusters(self, spike_ids, new_cluster_ids):
+        """Assign some spikes to new clusters, after a manual merge or split.
 
-        return Bunch(data=data, cols=None)
+        Contrary to assigning a new `spike_clusters` array, the spike index, the cluster ids,
+        the merge map and the cluster waveforms are updated incrementally, in time proportional
+        to the size of the affected clusters.
+
+        Parameters
+        ----------
+
+        spike_ids : array-like
+            Ids of the spikes to move, without duplicates.
+        new_cluster_ids : array-like or int
+            New cluster of every spike.
+
+        """
+        spike_ids = np.asarray(spike_ids, dtype=np.int64)
+        new_cluster_ids = np.broadcast_to(
+            np.asarray(new_cluster_ids, dtype=self.spike_clusters.dtype), spike_ids.shape)
+        old_cluster_ids = self.spike_clusters[spike_ids]
+
+        # Update the spike index and the spike clusters in place.
+        index = self.get_spike_index('clusters')
+        index.update(spike_ids, old_cluster_ids, new_cluster_ids)
+        self.spike_clusters[spike_ids] = new_cluster_ids
+
+        # Update the cluster ids.
+        old = np.unique(old_cluster_ids)
+        new = np.unique(new_cluster_ids)
+        emptied = [c for c in old if index.count(c) == 0]
+        self.cluster_ids = np.union1d(np.setdiff1d(self.cluster_ids, emptied), new)
+
+        # Update the merge map and the cluster waveforms (dense templates only). With sparse
+        # templates, the cluster waveforms and their number are those of the templates.
+        if self.sparse_templates is None or self.sparse_templates.cols is not None:
+            return
+        # Same number of clusters as when loading the model.
+        n_clusters = int(self.cluster_ids.max()) + 1 if len(self.cluster_ids) else 0
+        touched = np.union1d(old, new)
+        touched = touched[touched < n_clusters]
+        if not self.merge_map:
+            # Until now, the clusters were the templates: switch to explicit cluster waveforms.
+            template_ids = set(self.template_ids)
+            self.merge_map = {
+                t: [t] if t in template_ids else [] for t in range(self.n_clusters)}
+            data = np.array(self.sparse_templates.data[:self.n_clusters], dtype=np.float64)
+            # Clusters of templates without spikes have no waveform, as in cluster_waveforms().
+            data[[c for c, t in self.merge_map.items() if not t]] = 0
+            self.sparse_clusters = Bunch(data=data, cols=None)
+        self._resize_cluster_waveforms(n_clusters)
+        self.n_clusters = n_clusters
+        counts = self.get_cluster_template_counts(touched)
+        for i, cluster_id in enumerate(touched):
+            self.merge_map[int(cluster_id)] = \
+                counts.indices[counts.indptr[i]:counts.indptr[i + 1]].tolist()
+        for cluster_id in range(n_clusters, max(self.merge_map, default=-1) + 1):
+            self.merge_map.pop(cluster_id, None)
+        for cluster_id in range(n_clusters):
+            self.merge_map.setdefault(cluster_id, [])
+        self.nan_idx = np.array(
+            sorted(c for c, t in self.merge_map.items() if not t), dtype=np.int64)
+        self.sparse_clusters.data[touched] = self._cluster_waveforms(counts)
 
     #--------------------------------------------------------------------------
     # Saving methods
@@ -1362,13 +2242,63 @@ class TemplateModel(object):
             path, name, {c: v for c, v in values.items() if v is not None})
 
     def save_spike_clusters(self, spike_clusters):
-        """Save the spike clusters."""
+        """Save the spike clusters.
+
+        Only the spikes that changed since the last save are appended to the journal, which is
+        merged into spike_clusters.npy when it becomes too large, or when the model is closed.
+
+        """
+        spike_clusters = np.asarray(spike_clusters)
         path = self._find_path('spike_clusters.npy', 'spikes.clusters.npy', multiple_ok=False)
-        logger.debug("Save spike clusters to `%s`.", path)
-        np.save(path, spike_clusters)
+        saved = self._saved_spike_clusters
+        if not self.spike_clusters_journal or saved is None or \
+                saved.shape != spike_clusters.shape:
+            logger.debug("Save spike clusters to `%s`.", path)
+            _write_array_atomic(path, spike_clusters)
+            self._saved_spike_clusters = spike_clusters.astype(np.int32)
+            if _journal_path(path).exists():
+                _journal_path(path).unlink()
+            self._journal_dirty = False
+            return
+        changed = np.nonzero(spike_clusters != saved)[0]
+        if not len(changed):
+            return
+        logger.debug("Save %d spike cluster changes to the journal.", len(changed))
+        append_spike_clusters_journal(
+            _journal_path(path), changed, saved[changed], spike_clusters[changed])
+        saved[changed] = spike_clusters[changed]
+        self._journal_dirty = True
+        # Merge the journal into the spike clusters file when it becomes too large.
+        n_journal = _journal_path(path).stat().st_size // 24
+        if n_journal > self.journal_compaction_ratio * len(saved):
+            self.compact_spike_clusters()
+
+    def compact_spike_clusters(self):
+        """Merge the spike clusters journal into spike_clusters.npy.
+
+        The file is rebuilt from its current contents and the journal, which may contain changes
+        saved by other models opened on the same dataset.
+
+        """
+        path = self._find_path(
+            'spike_clusters.npy', 'spikes.clusters.npy', multiple_ok=False, mandatory=False)
+        if path is None or not _journal_path(path).exists():
+            return
+        logger.debug("Merge the spike clusters journal into `%s`.", path)
+        spike_clusters = _replay_spike_clusters_journal(np.load(path).astype(np.int32), path)
+        # NOTE: if the process crashes between these two steps, replaying the journal on top of
+        # the compacted file gives the same spike clusters.
+        _write_array_atomic(path, spike_clusters)
+        _journal_path(path).unlink()
+        self._journal_dirty = False
 
     def save_spikes_subset_waveforms(self, max_n_spikes_per_template=None, max_n_channels=None,
-                                     sample2unit=1.):
+                                     sample2unit=1., n_threads=None):
+        """Extract and save the waveforms of a subset of the spikes of every template.
+
+        The chunks of raw data are processed in `n_threads` threads (by default, `io_threads`).
+
+        """
         if self.traces is None:
             logger.warning(
                 "Spike waveforms could not be extracted as the raw data file is not available.")
@@ -1387,10 +2317,10 @@ class TemplateModel(object):
         path_channels = self.dir_path / '_phy_spikes_subset.channels.npy'
 
         # Subselection of spikes.
-        spt = _spikes_per_cluster(self.spike_templates)
-        template_ids = sorted(spt.keys())
+        spt = self.get_spike_index('templates')
+        template_ids = spt.cluster_ids
         ss = SpikeSelector(
-            get_spikes_per_cluster=lambda cl: spt.get(cl, np.array([], dtype=np.int64)),
+            get_spikes_per_cluster=lambda cl: spt.spikes([cl]),
             spike_times=self.spike_samples, chunk_bounds=self.traces.chunk_bounds,
             n_chunks_kept=n_chunks_kept)
         spike_ids = ss(max_n_spikes_per_template, template_ids, subset_chunks=True)
@@ -1401,8 +2331,7 @@ class TemplateModel(object):
         np.save(path_spikes, spike_ids)
 
         # Save the spike channels.
-        best_channels = np.vstack([
-            self._template_n_channels(t, nc) for t in range(self.n_templates)]).astype(np.int32)
+        best_channels = self._template_n_channels(nc)
         assert best_channels.ndim == 2
         assert best_channels.shape[0] == self.n_templates
         spike_channels = best_channels[self.spike_templates[spike_ids], :]
@@ -1413,13 +2342,22 @@ class TemplateModel(object):
         # Extract waveforms from the raw data on a chunk by chunk basis.
         export_waveforms(
             path, self.traces, self.spike_samples[spike_ids], spike_channels,
-            n_samples_waveforms=self.n_samples_waveforms, sample2unit=sample2unit)
+            n_samples_waveforms=self.n_samples_waveforms, sample2unit=sample2unit,
+            n_threads=n_threads if n_threads is not None else self.io_threads)
 
         # Reload spike waveforms.
         self.spike_waveforms = self._load_spike_waveforms()
+        self.waveform_cache.clear()
 
     def close(self):
-        """Close all memmapped files."""
+        """Merge the spike clusters journal if this model saved changes to it, and close the
+        raw data and all memmapped files."""
+        if self._journal_dirty:
+            self.compact_spike_clusters()
+        # NOTE: the raw data is not loaded just to be closed.
+        if self.__dict__.get('traces', None) is not None:
+            self.traces.close()
+        self.chunk_cache.clear()
         for k, v in sorted(self.__dict__.items(), key=itemgetter(0)):
             _close_memmap(k, v)
 
@@ -1452,6 +2390,12 @@ def get_template_params(params_path):
     return params
 
 
-def load_model(params_path):
-    """Return a TemplateModel instance from a path to a `params.py` file."""
-    return TemplateModel(**get_template_params(params_path))
+def load_model(params_path, **kwargs):
+    """Return a TemplateModel instance from a path to a `params.py` file.
+
+    Extra keyword arguments, for example `lazy=True`, are passed to the TemplateModel constructor.
+
+    """
+    params = get_template_params(params_path)
+    params.update(kwargs)
+    return TemplateModel(**params)
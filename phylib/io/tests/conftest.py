@@ -68,11 +68,22 @@ def _make_dataset(tempdir, param='dense', has_spike_attributes=True):
     for path in paths:
         to_path = tempdir / path.name
         # Skip sparse arrays if is_sparse is False.
-        if param == 'sparse' and ('_ind.' in str(to_path) or 'spike_ids.' in str(to_path)):
+        if param in ('sparse', 'spikeless') and (
+                '_ind.' in str(to_path) or 'spike_ids.' in str(to_path)):
             continue
         logger.debug("Copying file to %s.", to_path)
         shutil.copy(path, to_path)
 
+    # Files required by the model but missing in the test dataset.
+    n_templates = np.load(tempdir / 'templates.npy', mmap_mode='r').shape[0]
+    n_spikes = np.load(tempdir / 'spike_templates.npy', mmap_mode='r').shape[0]
+    if not (tempdir / 'template_clusters.npy').exists():
+        np.save(tempdir / 'template_clusters.npy', np.arange(n_templates, dtype=np.int32))
+    if not (tempdir / 'spike_channel_ranges.npy').exists():
+        n_channels = np.load(tempdir / 'channel_map.npy').size
+        ranges = np.tile(np.array([[0], [n_channels]], dtype=np.int32), (1, n_spikes))
+        np.save(tempdir / 'spike_channel_ranges.npy', ranges)
+
     # Some changes to files if 'misc' fixture parameter.
     if param == 'misc':
         # Remove spike_clusters and recreate it from spike_templates.
@@ -111,6 +122,13 @@ def _make_dataset(tempdir, param='dense', has_spike_attributes=True):
         clus[idx[3:]] = max_clus + 3
         np.save(tempdir / 'spike_clusters.npy', clus)
 
+    if param == 'spikeless':
+        # Move all spikes of a template to another one, to have a template without spikes.
+        for name in ('spike_templates.npy', 'spike_clusters.npy'):
+            st = np.load(tempdir / name)
+            st[st == 10] = 11
+            np.save(tempdir / name, st)
+
     # Spike attributes.
     if has_spike_attributes:
         write_array(tempdir / 'spike_fail.npy', np.full(10, np.nan))  # wrong number of spikes
@@ -133,7 +151,7 @@ def _make_dataset(tempdir, param='dense', has_spike_attributes=True):
     return template_path
 
 
-@fixture(scope='function', params=('dense', 'sparse', 'misc', 'merged'))
+@fixture(scope='function', params=('dense', 'sparse', 'misc', 'merged', 'spikeless'))
 def template_path_full(tempdir, request):
     return _make_dataset(tempdir, request.param)
 
@@ -13,8 +13,8 @@ from pytest import raises
 
 from ..array import (
     _unique, _normalize, _index_of, _spikes_in_clusters, _spikes_per_cluster,
-    _flatten_per_cluster, get_closest_clusters, _get_data_lim, _flatten, _clip,
-    chunk_bounds, excerpts, data_chunk, grouped_mean, SpikeSelector,
+    _flatten_per_cluster, _count_pairs, get_closest_clusters, _get_data_lim, _flatten, _clip,
+    chunk_bounds, excerpts, data_chunk, grouped_mean, SpikeSelector, SpikeIndex,
     get_excerpts, _range_from_slice, _pad, _get_padded,
     read_array, write_array)
 from phylib.utils._types import _as_array
@@ -309,12 +309,83 @@ def test_spikes_per_cluster():
         assert np.all(spike_clusters[spikes_per_cluster[i]] == i)
 
 
+def test_spike_index():
+    n_spikes = 100
+    n_clusters = 5
+    spike_clusters = artificial_spike_clusters(n_spikes, n_clusters)
+    spike_clusters[spike_clusters == 2] = 3
+
+    index = SpikeIndex(spike_clusters)
+    assert index.n_clusters == spike_clusters.max() + 1
+    ae(index.cluster_ids, np.unique(spike_clusters))
+    assert index.count(2) == 0
+    assert index.count(100) == 0
+
+    for clusters in ([0], [2], [3], [1, 3], [4, 0], [0, 1, 2, 3, 4], [10], []):
+        ae(index.spikes(clusters), _spikes_in_clusters(spike_clusters, clusters))
+        assert sum(index.count(c) for c in clusters) == len(index.spikes(clusters))
+    ae(index.spikes(1), _spikes_in_clusters(spike_clusters, [1]))
+
+    assert SpikeIndex([]).n_clusters == 0
+    ae(SpikeIndex([]).spikes([0]), [])
+
+
+def test_spike_index_update():
+    spike_clusters = artificial_spike_clusters(100, 5)
+    index = SpikeIndex(spike_clusters)
+
+    def _check():
+        ae(index.cluster_ids, np.unique(spike_clusters))
+        assert index.n_clusters >= spike_clusters.max() + 1
+        for cluster in range(index.n_clusters + 1):
+            ae(index.spikes([cluster]), _spikes_in_clusters(spike_clusters, [cluster]))
+        ae(index.spikes([1, 3, 7]), _spikes_in_clusters(spike_clusters, [1, 3, 7]))
+
+    # Split.
+    spike_ids = _spikes_in_clusters(spike_clusters, [2])[::2]
+    index.update(spike_ids, spike_clusters[spike_ids], 5)
+    spike_clusters[spike_ids] = 5
+    _check()
+
+    # Merge.
+    spike_ids = _spikes_in_clusters(spike_clusters, [0, 1])
+    index.update(spike_ids, spike_clusters[spike_ids], 7)
+    spike_clusters[spike_ids] = 7
+    _check()
+    assert index.count(0) == index.count(1) == 0
+
+    # Arbitrary reassignment.
+    spike_ids = np.array([3, 50, 20, 99])
+    new_clusters = np.array([0, 7, 3, 6])
+    index.update(spike_ids, spike_clusters[spike_ids], new_clusters)
+    spike_clusters[spike_ids] = new_clusters
+    _check()
+
+
 def test_flatten_per_cluster():
     spc = {2: [2, 7, 11], 3: [3, 5], 5: []}
     arr = _flatten_per_cluster(spc)
     ae(arr, [2, 3, 5, 7, 11])
 
 
+def test_count_pairs():
+    x = np.array([2, 0, 2, 2, 1, 0])
+    y = np.array([1, 3, 1, 0, 3, 3])
+    m = _count_pairs(x, y)
+    assert m.shape == (3, 4)
+    ae(m.toarray(), [[0, 0, 0, 2], [0, 0, 0, 1], [1, 2, 0, 0]])
+    ae(m.indices[m.indptr[2]:m.indptr[3]], [0, 1])
+
+    assert _count_pairs(x, y, shape=(4, 5)).shape == (4, 5)
+    assert _count_pairs([], []).shape == (0, 0)
+
+    # Large sparse table, counted without a dense histogram.
+    m = _count_pairs(x * 10000, y * 10000, shape=(30000, 40000))
+    assert m.nnz == 4
+    assert m[20000, 10000] == 2
+    ae(m.indices[m.indptr[20000]:m.indptr[20001]], [0, 10000])
+
+
 def test_grouped_mean():
     spike_clusters = np.array([2, 3, 2, 2, 5])
     arr = [9, -3, 10, 11, -5]
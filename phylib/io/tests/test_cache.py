@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+"""Testing the caches."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import os
+
+import numpy as np
+from numpy.testing import assert_equal as ae
+
+from ..cache import file_fingerprint, DiskCache, LRUCache
+
+
+#------------------------------------------------------------------------------
+# Tests
+#------------------------------------------------------------------------------
+
+def test_file_fingerprint(tempdir):
+    path = tempdir / 'a.npy'
+    np.save(path, np.arange(10))
+
+    fp = file_fingerprint([path])
+    assert fp == file_fingerprint([path])
+    assert fp != file_fingerprint([path], param=1)
+    assert file_fingerprint([path], param=1) != file_fingerprint([path], param=2)
+    assert fp != file_fingerprint([path, None])
+    assert fp != file_fingerprint([path, tempdir / 'b.npy'])
+
+    # Changing the file changes the fingerprint.
+    np.save(path, np.arange(20))
+    st = path.stat()
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert fp != file_fingerprint([path])
+
+
+def test_disk_cache(tempdir):
+    cache = DiskCache(tempdir / 'cache')
+    assert cache.load('x', 'key') is None
+
+    _calls = []
+
+    def compute():
+        _calls.append(0)
+        return {'arr': np.arange(5)}
+
+    ae(cache.get('x', 'key', compute)['arr'], np.arange(5))
+    ae(cache.get('x', 'key', compute)['arr'], np.arange(5))
+    assert len(_calls) == 1
+
+    # Outdated key.
+    assert cache.load('x', 'other') is None
+    cache.get('x', 'other', compute)
+    assert len(_calls) == 2
+
+    cache.clear()
+    assert cache.load('x', 'other') is None
+    cache.clear()
+
+
+def test_lru_cache():
+    cache = LRUCache(100)
+    assert cache.get('a') is None
+    cache.put('a', np.zeros(5))  # 40 bytes
+    cache.put('b', np.zeros(5))
+    ae(cache.get('a'), np.zeros(5))
+    assert cache.nbytes == 80
+
+    # 'b' is the least recently used entry.
+    cache.put('c', np.zeros(5))
+    assert 'b' not in cache
+    assert 'a' in cache and 'c' in cache
+    assert cache.nbytes == 80
+
+    # Replacing an entry.
+    cache.put('a', np.zeros(2))
+    assert cache.nbytes == 56
+
+    # Too large entries are not cached.
+    cache.put('d', np.zeros(20))
+    assert 'd' not in cache
+    cache.put('e', None, nbytes=10)
+    assert 'e' in cache
+
+    assert cache.hits == 1
+    assert cache.misses == 1
+    assert cache.hit_rate == .5
+    assert cache.stats()['n_entries'] == 3
+
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.nbytes == 0
+
+    # Disabled cache.
+    cache = LRUCache(0)
+    cache.put('a', np.zeros(1))
+    assert len(cache) == 0
@@ -14,7 +14,10 @@ from pytest import raises
 
 # from phylib.utils import Bunch
 from phylib.utils.testing import captured_output
-from ..model import from_sparse, load_model
+from ..model import (
+    from_sparse, load_model, read_array, _sanitize_array, _find_empty_rows,
+    append_spike_clusters_journal, load_spike_clusters_journal,
+    get_closest_channels, get_channel_neighbors, _best_channels_from_amplitudes)
 
 logger = logging.getLogger(__name__)
 
@@ -45,6 +48,41 @@ def test_from_sparse():
         _test([19, 19], [[0, 0], [4, 4]])
 
 
+def test_channel_neighbors():
+    positions = np.c_[np.zeros(6), np.arange(6)]
+    shanks = np.array([0, 0, 0, 1, 1, 1])
+
+    neighbors = get_channel_neighbors(positions, 3)
+    for channel in range(6):
+        ae(neighbors[channel], get_closest_channels(positions, channel, 3))
+
+    neighbors = get_channel_neighbors(positions, 3, channel_shanks=shanks)
+    ae(neighbors[2], [2, 1, -1])
+    ae(neighbors[3], [3, -1, 4])
+    assert get_channel_neighbors(positions).shape == (6, 6)
+
+
+def test_best_channels():
+    positions = np.c_[np.zeros(6), np.arange(6)]
+    neighbors = get_channel_neighbors(positions, 3)
+    amplitudes = np.array([
+        [1, 5, 3, 0, 0, 0],
+        [0, 0, 1, 2, 4, 3],
+        [0, 0, 0, 0, 0, 1],
+    ], dtype=np.float32)
+
+    best = _best_channels_from_amplitudes(amplitudes, neighbors)
+    ae(best.best_channel, [1, 4, 5])
+    ae(best.n_channels, [3, 3, 3])
+    ae(best.channel_ids, [[1, 2, 0], [4, 5, 3], [5, 4, 3]])
+    ae(best.amplitude, [[5, 3, 1], [4, 3, 2], [1, 0, 0]])
+
+    best = _best_channels_from_amplitudes(amplitudes, neighbors, amplitude_threshold=.5)
+    ae(best.n_channels, [2, 3, 1])
+    ae(best.channel_ids, [[1, 2, -1], [4, 5, 3], [5, -1, -1]])
+    ae(best.amplitude[0], [5, 3, 0])
+
+
 def test_model_1(template_model_full):
     with captured_output() as (stdout, stderr):
         template_model_full.describe()
@@ -135,6 +173,86 @@ def test_model_save(template_model_full):
     m.save_spike_clusters(m.spike_clusters)
 
 
+def test_spike_clusters_journal(tempdir):
+    path = tempdir / 'spike_clusters.journal'
+    assert load_spike_clusters_journal(path) == []
+
+    append_spike_clusters_journal(path, [1, 3], [0, 0], [5, 5])
+    append_spike_clusters_journal(path, [2], [1], [6])
+    actions = load_spike_clusters_journal(path)
+    assert len(actions) == 2
+    ae(actions[0].spike_ids, [1, 3])
+    ae(actions[0].old_clusters, [0, 0])
+    ae(actions[0].new_clusters, [5, 5])
+    ae(actions[1].new_clusters, [6])
+
+    # Truncated last action.
+    with open(path, 'ab') as f:
+        f.write(np.array([-1, 10, 0, 4, 1], dtype=np.int64).tobytes())
+    assert len(load_spike_clusters_journal(path)) == 2
+
+
+def test_model_save_journal(template_path_full):
+    m = load_model(template_path_full, spike_clusters_journal=True, journal_compaction_ratio=1)
+    journal = template_path_full.parent / 'spike_clusters.journal'
+    sc_path = template_path_full.parent / 'spike_clusters.npy'
+    sc_file = np.load(sc_path)
+
+    sc = m.spike_clusters.copy()
+    sc[:10] = sc.max() + 1
+    m.save_spike_clusters(sc)
+    assert journal.exists()
+    # The spike clusters file was not rewritten.
+    ae(np.load(sc_path), sc_file)
+
+    sc[5:20] = sc.max() + 1
+    m.save_spike_clusters(sc)
+    assert len(load_spike_clusters_journal(journal)) == 2
+    m.save_spike_clusters(sc)
+    assert len(load_spike_clusters_journal(journal)) == 2
+
+    # The journal is replayed when loading the model, and is not merged by models that did not
+    # save changes to it.
+    m2 = load_model(template_path_full)
+    ae(m2.spike_clusters, sc)
+    m2.close()
+    assert journal.exists()
+
+    # The journal is merged into the spike clusters file when closing the model.
+    m.close()
+    assert not journal.exists()
+    ae(np.load(sc_path), sc)
+
+    # Compaction when the journal becomes too large.
+    m = load_model(template_path_full, spike_clusters_journal=True, journal_compaction_ratio=0)
+    sc[0] = sc.max() + 1
+    m.save_spike_clusters(sc)
+    assert not journal.exists()
+    ae(np.load(sc_path), sc)
+    m.close()
+
+
+def test_model_save_journal_shared(template_path_full):
+    m1 = load_model(template_path_full, spike_clusters_journal=True)
+    m2 = load_model(template_path_full, spike_clusters_journal=True)
+    sc_path = template_path_full.parent / 'spike_clusters.npy'
+
+    sc1 = m1.spike_clusters.copy()
+    sc1[:10] = sc1.max() + 1
+    m1.save_spike_clusters(sc1)
+    sc2 = m2.spike_clusters.copy()
+    sc2[-10:] = sc2.max() + 2
+    m2.save_spike_clusters(sc2)
+
+    # The compaction keeps the changes saved by both models.
+    m1.close()
+    sc = np.load(sc_path)
+    ae(sc[:10], sc1[:10])
+    ae(sc[-10:], sc2[-10:])
+    m2.close()
+    ae(np.load(sc_path), sc)
+
+
 def test_model_spike_waveforms(template_path_full):
     model = load_model(template_path_full)
 
@@ -178,6 +296,57 @@ def test_model_spike_waveforms(template_path_full):
     model.close()
 
 
+def test_model_spike_waveforms_partial(template_path_full):
+    model = load_model(template_path_full)
+    if model.traces is None:  # pragma: no cover
+        return
+    model.save_spikes_subset_waveforms(5, 16)
+    assert model.spike_waveforms is not None
+
+    tid = model.template_ids[0]
+    spike_ids = model.get_template_spikes(tid)
+    # Only request channels covered by the precomputed waveforms.
+    channel_ids = model.get_template_channels(tid)[:5]
+    found = np.isin(spike_ids, model.spike_waveforms.spike_ids)
+    assert found.any() and not found.all()
+
+    # Spikes without precomputed waveforms are extracted from the raw data.
+    w = model.get_waveforms(spike_ids, channel_ids)
+    model.spike_waveforms = None
+    model.waveform_cache.clear()
+    ae(w, model.get_waveforms(spike_ids, channel_ids))
+    model.close()
+
+
+def test_model_waveform_cache(template_path_full):
+    model = load_model(template_path_full, waveform_cache_size=10 * 1024 ** 2)
+    if model.traces is None:  # pragma: no cover
+        return
+    spike_ids = model.get_template_spikes(model.template_ids[0])[:10]
+    channel_ids = model.get_template_channels(model.template_ids[0])
+
+    w = model.get_waveforms(spike_ids, channel_ids)
+    assert model.waveform_cache.misses == 1
+    w[:] = 0
+    ae(model.get_waveforms(spike_ids, channel_ids), model._get_waveforms(spike_ids, channel_ids))
+    assert model.waveform_cache.hits == 1
+    model.get_waveforms(spike_ids, channel_ids[:2])
+    assert model.waveform_cache.misses == 2
+    assert model.waveform_cache.stats()['n_entries'] == 2
+
+    # The cache is kept when changing the spike clusters.
+    model.update_spike_clusters(spike_ids, model.spike_clusters.max() + 1)
+    model.get_waveforms(spike_ids, channel_ids)
+    assert model.waveform_cache.hits == 2
+
+    # The cache is disabled by default.
+    model.close()
+    model = load_model(template_path_full)
+    model.get_waveforms(spike_ids, channel_ids)
+    assert len(model.waveform_cache) == 0
+    model.close()
+
+
 def test_model_metadata_1(template_model_full):
     m = template_model_full
 
@@ -218,3 +387,321 @@ def test_model_spike_attributes(template_model_full):
     assert set(model.spike_attributes.keys()) == set(('randn', 'works'))
     assert model.spike_attributes.works.shape == (model.n_spikes,)
     assert model.spike_attributes.randn.shape == (model.n_spikes, 2)
+
+
+def test_model_lazy(template_path_full):
+    model = load_model(template_path_full, lazy=True)
+    assert 'spike_clusters' not in model.__dict__
+    assert 'sparse_templates' not in model.__dict__
+
+    # The data is loaded on first access.
+    assert model.spike_clusters.shape == (model.n_spikes,)
+    assert 'spike_clusters' in model.__dict__
+    assert 'sparse_templates' not in model.__dict__
+
+    eager = load_model(template_path_full)
+    ae(model.spike_clusters, eager.spike_clusters)
+    ae(model.cluster_ids, eager.cluster_ids)
+    ae(model.sparse_clusters.data, eager.sparse_clusters.data)
+    ae(model.get_template(3).channel_ids, eager.get_template(3).channel_ids)
+    assert model.metadata == eager.metadata
+
+    model.close()
+    eager.close()
+
+
+def test_model_lazy_set(template_path_full):
+    model = load_model(template_path_full, lazy=True)
+
+    # Attributes set before being loaded are not overwritten by the loading.
+    spike_clusters = np.zeros(model.n_spikes, dtype=np.int32)
+    model.spike_clusters = spike_clusters
+    ae(model.cluster_ids, [0])
+    assert model.spike_clusters is spike_clusters
+
+    # Every init method runs once, even if it leaves optional attributes unset.
+    calls = []
+    init = model._init_features
+    model._init_features = lambda: calls.append(init())
+    for _ in range(2):
+        getattr(model, 'n_features_per_channel', None)
+    assert len(calls) == 1
+
+    # An init method that fails raises the same error on every access, until it succeeds.
+    def _fail():
+        raise IOError("corrupt file")
+    model._init_channels = _fail
+    for _ in range(2):
+        with raises(IOError, match='corrupt'):
+            model.channel_mapping
+    del model._init_channels
+    assert model.n_channels == len(model.channel_mapping)
+
+    model.close()
+
+
+def test_model_cache(template_path_full):
+    # The cache is disabled by default.
+    load_model(template_path_full).close()
+    assert not (template_path_full.parent / '.phy_cache').exists()
+
+    model = load_model(template_path_full, cache_dir='.phy_cache')
+    assert (model.dir_path / '.phy_cache').exists()
+
+    # The second time, the derived data is loaded from the cache.
+    cached = load_model(template_path_full, cache_dir='.phy_cache')
+    ae(cached.template_ids, model.template_ids)
+    ae(cached.cluster_ids, model.cluster_ids)
+    assert cached.merge_map == model.merge_map
+    ae(cached.sparse_clusters.data, model.sparse_clusters.data)
+    cached.close()
+
+    # Absolute cache directory.
+    cache_dir = template_path_full.parent / 'cache'
+    cached = load_model(template_path_full, cache_dir=cache_dir)
+    ae(cached.cluster_ids, model.cluster_ids)
+    assert list(cache_dir.glob('*.pkl'))
+    cached.close()
+
+    model.close()
+
+
+def test_model_io_threads(template_path_full):
+    model = load_model(template_path_full, io_threads=4)
+    assert not model._prefetched
+
+    expected = load_model(template_path_full, io_threads=0)
+    ae(model.spike_times, expected.spike_times)
+    ae(model.spike_clusters, expected.spike_clusters)
+    ae(model.channel_positions, expected.channel_positions)
+    ae(model.similar_templates, expected.similar_templates)
+    assert set(model.spike_attributes) == set(expected.spike_attributes)
+
+    model.close()
+    expected.close()
+
+
+def test_model_merge_map(template_model_full):
+    m = template_model_full
+    merge_map, nan_idx = m.get_merge_map()
+    assert sorted(merge_map) == list(range(m.spike_clusters.max() + 1))
+    for cluster, templates in merge_map.items():
+        ae(templates, np.unique(m.spike_templates[m.spike_clusters == cluster]))
+    ae(nan_idx, [c for c, t in merge_map.items() if not t])
+
+    counts = m.get_cluster_template_counts()
+    assert counts.sum() == m.n_spikes
+    ae(counts[3].toarray().ravel(), m.get_template_counts(3)[:counts.shape[1]])
+
+
+def test_model_cluster_waveforms(template_model_full):
+    m = template_model_full
+    if m.sparse_templates.cols is not None:
+        return
+    data = m.cluster_waveforms().data
+    assert data.shape == (m.spike_clusters.max() + 1, m.n_samples_waveforms, m.n_channels)
+    merge_map, _ = m.get_merge_map()
+    for cluster, templates in merge_map.items():
+        if len(templates) == 1:
+            ae(data[cluster], m.sparse_templates.data[templates[0]])
+        elif len(templates) > 1:
+            mw = m.get_cluster_mean_waveforms(cluster, unwhiten=False)
+            np.testing.assert_allclose(
+                data[cluster][:, mw.channel_ids], mw.mean_waveforms, atol=1e-6)
+        else:
+            assert np.all(data[cluster] == 0)
+
+
+def test_read_array_nan(tempdir):
+    arr = np.random.randn(100, 7)
+    arr[3, 2] = np.nan
+    arr[50:60, 1] = np.inf
+    arr[99, :] = -np.inf
+    path = tempdir / 'arr.npy'
+    np.save(path, arr)
+
+    out = read_array(path)
+    assert np.all(np.isfinite(out))
+    assert np.sum(out == 0) == 1 + 10 + 7
+    ae(out[:3], arr[:3])
+
+    # Chunks smaller than a row.
+    arr_s = arr.copy()
+    _sanitize_array(arr_s, chunk_size=3)
+    ae(arr_s, out)
+
+    # Integer arrays are left untouched.
+    ae(_sanitize_array(np.arange(5)), np.arange(5))
+
+
+def test_find_empty_rows(tempdir):
+    arr = np.random.randn(10, 4, 3)
+    arr[[2, 7]] = np.nan
+    arr[5, 0, 0] = np.nan
+    path = tempdir / 'templates.npy'
+    np.save(path, arr)
+
+    data = read_array(path, mmap_mode='c')
+    for chunk_size in (1, 12, 25, None):
+        ae(np.nonzero(_find_empty_rows(data, chunk_size=chunk_size))[0], [2, 7])
+
+    # Copy-on-write memmap: the file is not modified.
+    data[[2, 7]] = 0
+    assert np.isnan(np.load(path)[2]).all()
+
+
+def test_model_best_channels(template_model_full):
+    m = template_model_full
+    best = m.get_best_channels()
+    assert m.get_best_channels() is best
+    assert best.channel_ids.shape[0] == m.n_templates
+    for template_id in m.template_ids:
+        n = best.n_channels[template_id]
+        ae(best.channel_ids[template_id, :n], m.get_template(template_id).channel_ids)
+        assert np.all(best.channel_ids[template_id, n:] == -1)
+
+    # With dense templates, amplitude[i] is the amplitude on channel_ids[i].
+    if m.sparse_templates.cols is None:
+        for template_id in m.template_ids:
+            template = m.get_template(template_id)
+            ptp = template.template.max(axis=0) - template.template.min(axis=0)
+            np.testing.assert_allclose(template.amplitude, ptp, rtol=1e-5, atol=1e-6)
+            assert np.all(np.diff(template.amplitude) <= 0)
+
+    channels = m._template_n_channels(4)
+    assert channels.shape == (m.n_templates, 4)
+    ae(channels[m.template_ids[0]], best.channel_ids[m.template_ids[0], :4])
+
+
+def test_model_get_templates(template_model_full):
+    m = template_model_full
+    template_ids = m.template_ids[[2, 0, 1, 2]]
+    for unwhiten in (True, False):
+        templates = m.get_templates(template_ids, unwhiten=unwhiten)
+        assert templates.data.shape[:2] == (len(template_ids), m.n_samples_waveforms)
+        assert templates.channel_ids.shape == templates.data.shape[::2]
+        for i, template_id in enumerate(template_ids):
+            template = m.get_template(template_id, unwhiten=unwhiten)
+            n = templates.n_channels[i]
+            ae(templates.channel_ids[i, :n], template.channel_ids)
+            np.testing.assert_allclose(
+                templates.data[i, :, :n], template.template, rtol=1e-5, atol=1e-6)
+            assert np.all(templates.data[i, :, n:] == 0)
+            assert templates.best_channel[i] == template.best_channel
+    assert m.get_templates([]).data.shape[0] == 0
+
+
+def test_model_template_store(template_path_full):
+    model = load_model(template_path_full)
+    store_model = load_model(template_path_full, template_store=True, cache_dir='.phy_cache')
+
+    for template_id in model.template_ids[:5]:
+        expected = model.get_template(template_id)
+        template = store_model.get_template(template_id)
+        ae(template.channel_ids, expected.channel_ids)
+        assert template.channel_ids.dtype == expected.channel_ids.dtype
+        assert template.best_channel == expected.best_channel
+        np.testing.assert_allclose(template.template, expected.template, rtol=1e-5, atol=1e-6)
+        np.testing.assert_allclose(template.amplitude, expected.amplitude, rtol=1e-5, atol=1e-6)
+        # The returned arrays are copies of the store.
+        assert template.template.flags.writeable
+        template.template[:] = 0
+    ae(store_model.get_template(model.template_ids[0]).template,
+       store_model.get_template(model.template_ids[0]).template)
+    assert np.any(store_model.get_template(model.template_ids[0]).template)
+    store = store_model.get_template_store()
+    assert store.data.dtype == np.float32
+    assert isinstance(store.data, np.memmap)
+
+    templates = store_model.get_templates(model.template_ids[:5])
+    expected = model.get_templates(model.template_ids[:5])
+    np.testing.assert_allclose(templates.data, expected.data, rtol=1e-5, atol=1e-6)
+
+    if model.sparse_templates.cols is None:
+        for arr, expected in zip(
+                store_model.get_amplitudes_true(), model.get_amplitudes_true()):
+            np.testing.assert_allclose(arr, expected, rtol=1e-5, atol=1e-6)
+    model.close()
+    store_model.close()
+
+    # The store is loaded from the cache directory.
+    store_model = load_model(template_path_full, template_store=True, cache_dir='.phy_cache')
+    ae(store_model.get_template_store().channel_ids, store.channel_ids)
+    store_model.close()
+
+
+def test_model_spike_index(template_model_full):
+    m = template_model_full
+    for cluster_id in m.cluster_ids:
+        ae(m.get_cluster_spikes(cluster_id), np.nonzero(m.spike_clusters == cluster_id)[0])
+    for template_id in m.template_ids:
+        ae(m.get_template_spikes(template_id), np.nonzero(m.spike_templates == template_id)[0])
+    index = m.get_spike_index()
+    assert m.get_spike_index() is index
+
+    # The index is rebuilt when spike_clusters is replaced.
+    spike_clusters = m.spike_clusters.copy()
+    spike_clusters[:10] = 1000
+    m.spike_clusters = spike_clusters
+    assert m.get_spike_index() is not index
+    ae(m.get_cluster_spikes(1000), np.arange(10))
+
+    # The indexed arrays stay writeable.
+    assert m.spike_clusters.flags.writeable
+    assert m.spike_templates.flags.writeable
+
+    # The index is kept up-to-date by update_spike_clusters().
+    m.update_spike_clusters(np.arange(5), 1001)
+    ae(m.get_cluster_spikes(1001), np.arange(5))
+    ae(m.get_cluster_spikes(1000), np.arange(5, 10))
+
+    # In-place changes followed by an assignment of the same array.
+    m.spike_clusters[5:10] = 1001
+    m.spike_clusters = m.spike_clusters
+    ae(m.get_cluster_spikes(1001), np.arange(10))
+    assert len(m.get_cluster_spikes(1000)) == 0
+
+
+def test_model_update_spike_clusters(template_model_full):
+    m = template_model_full
+
+    def _check():
+        sc = m.spike_clusters
+        ae(m.cluster_ids, np.unique(sc))
+        for cluster_id in range(sc.max() + 1):
+            ae(m.get_cluster_spikes(cluster_id), np.nonzero(sc == cluster_id)[0])
+        if m.merge_map:
+            merge_map, _ = m.get_merge_map()
+            for cluster_id, templates in merge_map.items():
+                assert m.merge_map[cluster_id] == templates
+            expected = m.cluster_waveforms().data
+            np.testing.assert_allclose(
+                m.sparse_clusters.data[:len(expected)], expected, atol=1e-6)
+            assert m.sparse_clusters.data.shape[0] == m.n_clusters
+
+    # Split a cluster.
+    spike_ids = m.get_cluster_spikes(m.cluster_ids[2])
+    new_id = m.spike_clusters.max() + 1
+    m.update_spike_clusters(spike_ids[::2], new_id)
+    _check()
+    assert new_id in m.cluster_ids
+
+    # Merge two clusters.
+    spike_ids = np.union1d(
+        m.get_cluster_spikes(m.cluster_ids[0]), m.get_cluster_spikes(m.cluster_ids[1]))
+    m.update_spike_clusters(spike_ids, m.spike_clusters.max() + 1)
+    _check()
+
+    # Empty the last cluster.
+    m.update_spike_clusters(m.get_cluster_spikes(m.cluster_ids[-1]), m.cluster_ids[0])
+    _check()
+
+    # The clusters are the same as when loading the model with the new spike clusters.
+    m.save_spike_clusters(m.spike_clusters)
+    fresh = load_model(m.dir_path / 'params.py')
+    assert m.n_clusters == fresh.n_clusters
+    ae(m.cluster_ids, fresh.cluster_ids)
+    assert m.merge_map == fresh.merge_map
+    ae(m.nan_idx, fresh.nan_idx)
+    np.testing.assert_allclose(m.sparse_clusters.data, fresh.sparse_clusters.data, atol=1e-6)
+    fresh.close()
@@ -13,12 +13,17 @@ from numpy.testing import assert_equal as ae
 from numpy.testing import assert_allclose as ac
 import mtscomp
 from pytest import raises, fixture, mark
+from scipy import signal
 
 from phylib.utils import Bunch
+from phylib.utils.testing import captured_logging
+from ..array import get_excerpts
+from ..cache import LRUCache
 from ..traces import (
-    _get_subitems, _get_chunk_bounds,
+    _get_subitems, _get_chunk_bounds, _group_windows, _extract_waveform, _extract_waveforms,
     get_ephys_reader, BaseEphysReader, extract_waveforms, export_waveforms, RandomEphysReader,
-    get_spike_waveforms)
+    get_spike_waveforms, PrefetchEphysReader, FilteredEphysReader, SubsetEphysReader,
+    _split_bounds, _take)
 
 logger = logging.getLogger(__name__)
 
@@ -102,7 +107,8 @@ def sample_rate(request):
     return request.param
 
 
-@fixture(params=['numpy', 'npy', 'flat', 'flat_concat', 'mtscomp', 'mtscomp_reader'])
+@fixture(params=[
+    'numpy', 'npy', 'flat', 'flat_concat', 'mtscomp', 'mtscomp_reader', 'mtscomp_concat'])
 def traces(request, tempdir, arr, sample_rate):
     if request.param == 'numpy':
         return get_ephys_reader(arr, sample_rate=sample_rate)
@@ -145,6 +151,18 @@ def traces(request, tempdir, arr, sample_rate):
         else:
             return get_ephys_reader(out)
 
+    elif request.param == 'mtscomp_concat':
+        paths = []
+        for i, part in enumerate((arr[:arr.shape[0] // 3], arr[arr.shape[0] // 3:])):
+            path = tempdir / ('data%d.bin' % i)
+            part.tofile(path)
+            paths.append(path.with_suffix('.cbin'))
+            mtscomp.compress(
+                path, paths[-1], path.with_suffix('.ch'), sample_rate=sample_rate,
+                n_channels=arr.shape[1], dtype=arr.dtype,
+                n_threads=1, check_after_compress=False, quiet=True)
+        return get_ephys_reader(paths)
+
 
 def test_ephys_reader_1(tempdir, arr, traces, sample_rate):
     assert isinstance(traces, BaseEphysReader)
@@ -201,6 +219,215 @@ def test_ephys_reader_1(tempdir, arr, traces, sample_rate):
     _a(lambda x: x[::1, ::3])
 
 
+def test_ephys_reader_ops(traces, arr):
+    def _a(f):
+        expected = f(arr)
+        actual = f(traces)[:]
+        assert actual.dtype == expected.dtype
+        ac(actual, expected)
+
+    # Column selections after arithmetic operations, with per-channel arguments.
+    scale = np.linspace(1, 2, arr.shape[1])
+    _a(lambda x: (x * scale)[:, [3, 1, 1]])
+    _a(lambda x: (2 - x / scale)[:, 2:6][:, ::-1])
+    _a(lambda x: (x * 2)[:, arr[0] > 0] + 1)
+
+    # The same reader can be read several times.
+    r = (traces * .5)[:, [0, 2]]
+    ae(r[:10], r[:10])
+
+    # Integer overflow before the promotion to floating point.
+    arr = (arr * 10000).astype(np.int16)
+    traces = get_ephys_reader(arr, sample_rate=traces.sample_rate)
+    _a(lambda x: x * 1000 * .5)
+    _a(lambda x: -x // 3 * 2.5)
+    _a(lambda x: 1. / (x - 300000))
+    _a(lambda x: (x + np.int16(1))[:, 1:4])
+
+
+def test_take():
+    arr = np.arange(20).reshape((4, 5))
+    ae(_take(arr, slice(1, 3), [4, 0]), arr[1:3][:, [4, 0]])
+    ae(_take(arr, np.array([0, 3]), [4, 0]), arr[[0, 3]][:, [4, 0]])
+    ae(_take(arr, np.array([0, 3]), slice(1, 3)), arr[[0, 3], 1:3])
+    ae(_take(arr, 2, [1, 2]), arr[2, [1, 2]])
+
+
+def test_ephys_reader_cols(traces, arr):
+    r = (traces * 2)[:, [5, 1]]
+    ac(r[[1, 2, 50, arr.shape[0] - 1]], arr[[1, 2, 50, -1]][:, [5, 1]] * 2)
+    ac(r[10], arr[10:11, [5, 1]] * 2)
+    ac(r[10:-10], arr[10:-10, [5, 1]] * 2)
+
+
+def test_ephys_mtscomp_concat(tempdir, arr, sample_rate):
+    paths = []
+    for i, part in enumerate((arr[:50], arr[50:60], arr[60:])):
+        path = tempdir / ('data%d.bin' % i)
+        part.tofile(path)
+        paths.append(path.with_suffix('.cbin'))
+        mtscomp.compress(
+            path, paths[-1], path.with_suffix('.ch'), sample_rate=sample_rate,
+            n_channels=arr.shape[1], dtype=arr.dtype, chunk_duration=.01,
+            n_threads=1, check_after_compress=False, quiet=True)
+    reader = get_ephys_reader(paths)
+    assert reader.n_parts == 3
+    assert reader.part_bounds == [0, 50, 60, arr.shape[0]]
+    assert set(reader.part_bounds).issubset(reader.chunk_bounds)
+    assert reader.chunk_bounds[-1] == arr.shape[0]
+
+    # Reads over several files.
+    ac(reader[40:70], arr[40:70])
+    ac(reader[55], arr[55:56])
+    ac(reader[:, [2, 0]][:], arr[:, [2, 0]])
+
+    # The chunks cover all files.
+    chunks = [(i0, i1) for i0, i1 in reader.iter_chunks() if i1 > i0]
+    assert chunks[0][0] == 0
+    assert chunks[-1][1] == arr.shape[0]
+    assert all(c0[1] == c1[0] for c0, c1 in zip(chunks[:-1], chunks[1:]))
+    ac(np.vstack([reader[i0:i1] for i0, i1 in chunks]), arr)
+
+    # Closing a wrapper closes the files and stops the decompression threads.
+    reader.subset_time_range((0, 1)).filter(low=1.).close()
+    assert reader._executor._shutdown
+    assert all(r.cdata.closed for r in reader.readers)
+
+    # Files with a different number of channels cannot be concatenated.
+    path = tempdir / 'other.bin'
+    arr[:, :2].tofile(path)
+    mtscomp.compress(
+        path, path.with_suffix('.cbin'), path.with_suffix('.ch'), sample_rate=sample_rate,
+        n_channels=2, dtype=arr.dtype, n_threads=1, check_after_compress=False, quiet=True)
+    with raises(ValueError):
+        get_ephys_reader([paths[0], path.with_suffix('.cbin')])
+
+
+def test_ephys_reader_fancy(traces, arr):
+    n = arr.shape[0]
+
+    def _a(item):
+        ac(traces[item], arr[item])
+        ac(traces[item, [4, 0]], arr[item][:, [4, 0]])
+        ac((traces * 2)[:, 1:3][item], arr[item][:, 1:3] * 2)
+
+    # Unsorted and duplicate indices.
+    _a([5, 3, 3, n - 1, 0, 5])
+    _a(np.random.RandomState(0).randint(0, n, 100))
+    _a(np.array([n // 2, n // 2]))
+    # Negative indices.
+    _a([-1, 2, -n])
+    # Boolean masks.
+    _a(np.arange(n) % 7 == 0)
+    # Strided slices.
+    _a(slice(None, None, 3))
+    _a(slice(10, n - 10, 17))
+    _a(slice(None, None, -5))
+    # Empty selections.
+    assert traces[[]].shape == (0, arr.shape[1])
+    assert traces[[], [1, 2]].shape == (0, 2)
+
+    with raises(IndexError):
+        traces[[0, n]]
+
+
+def test_read_windows(traces, arr):
+    n = arr.shape[0]
+    # Unsorted, overlapping and adjacent windows, and windows on the edges of the data.
+    starts = np.array([100, 0, 105, 110, 130, n - 10, 50, 100])
+    length = 20
+
+    def _expected(data):
+        padded = np.concatenate((data, np.zeros((length, data.shape[1]), dtype=data.dtype)))
+        return np.stack([padded[i:i + length] for i in starts])
+
+    w = traces.read_windows(starts, length)
+    assert w.shape == (len(starts), length, arr.shape[1])
+    ac(w, _expected(arr))
+
+    w = traces.read_windows(starts, length, channels=[4, 1])
+    ac(w, _expected(arr[:, [4, 1]]))
+
+    # The data type of the lazy operations is preserved.
+    int_traces = get_ephys_reader((arr * 100).astype(np.int16), sample_rate=traces.sample_rate)
+    w = (int_traces * .5)[:, 1:4].read_windows(starts, length)
+    assert w.dtype == np.float64
+    ac(w, _expected((arr * 100).astype(np.int16)[:, 1:4] * .5))
+
+    assert traces.read_windows([], length).shape == (0, length, arr.shape[1])
+
+    # Excerpts are read at once.
+    ac(get_excerpts(traces, n_excerpts=10, excerpt_size=15),
+       get_excerpts(arr, n_excerpts=10, excerpt_size=15))
+
+
+def test_ephys_subset_time_range(traces, arr):
+    sr = traces.sample_rate
+    i0, i1 = arr.shape[0] // 4, 3 * arr.shape[0] // 4
+    view = traces.subset_time_range((i0 / sr, i1 / sr))
+    assert isinstance(view, SubsetEphysReader)
+    assert (view.sample_onset, view.sample_offset) == (i0, i1)
+    assert view.shape == (i1 - i0, arr.shape[1])
+    assert view.chunk_bounds[0] == 0 and view.chunk_bounds[-1] == i1 - i0
+    assert view.part_bounds[0] == 0 and view.part_bounds[-1] == i1 - i0
+
+    ac(view[:], arr[i0:i1])
+    ac(view[10:20], arr[i0 + 10:i0 + 20])
+    ac(view[-1], arr[i1 - 1:i1])
+    ac((view[:, [3, 1]] * 2)[5:15], arr[i0 + 5:i0 + 15, [3, 1]] * 2)
+    ac(np.vstack([view[j0:j1] for j0, j1 in view.iter_chunks()]), arr[i0:i1])
+
+    # Nested views refer to the original reader.
+    nested = view.subset_time_range((1 / sr, 11 / sr))
+    assert nested.reader is traces
+    assert (nested.sample_onset, nested.sample_offset) == (i0 + 1, i0 + 11)
+    ac(nested[:], arr[i0 + 1:i0 + 11])
+
+    # The view is clipped to the data.
+    assert traces.subset_time_range((-1, 1e9)).shape == arr.shape
+
+
+def test_ephys_subset_time_range_filtered(arr):
+    reader = get_ephys_reader(arr, sample_rate=1000.).filter(low=100.)
+    view = reader[:, [1, 2]].subset_time_range((.05, .15))
+    assert view.n_channels == 2
+    ac(view[:], reader[50:150, [1, 2]])
+
+
+def test_mtscomp_chunk_cache(tempdir, arr, sample_rate):
+    paths = []
+    for i, part in enumerate((arr[:100], arr[100:])):
+        path = tempdir / ('data%d.bin' % i)
+        part.tofile(path)
+        paths.append(path.with_suffix('.cbin'))
+        mtscomp.compress(
+            path, paths[-1], path.with_suffix('.ch'), sample_rate=sample_rate,
+            n_channels=arr.shape[1], dtype=arr.dtype, chunk_duration=.01,
+            n_threads=1, check_after_compress=False, quiet=True)
+    chunk_size = int(.01 * sample_rate) * arr.shape[1] * arr.itemsize
+    cache = LRUCache(12 * chunk_size)
+
+    reader = get_ephys_reader(paths, chunk_cache=cache)
+    ac(reader[5:15], arr[5:15])
+    assert cache.misses > 0
+    assert cache.hits == 0
+    misses = cache.misses
+
+    # The chunks are decompressed once, and are shared by the readers of the same files.
+    other = get_ephys_reader(paths, chunk_cache=cache)
+    ac(other[6:14], arr[6:14])
+    ac(reader[[5, 14, 10]], arr[[5, 14, 10]])
+    assert cache.misses == misses
+    assert cache.hits > 0
+    assert 0 < cache.hit_rate < 1
+
+    # The cache has a byte budget.
+    ac(reader[:], arr)
+    ac(np.vstack([reader[i0:i1] for i0, i1 in reader.iter_chunks() if i1 > i0]), arr)
+    assert cache.nbytes <= cache.max_bytes
+    assert len(cache) <= 12
+
+
 def test_ephys_random(sample_rate):
     reader = RandomEphysReader(2000, 10, sample_rate=sample_rate)
     assert reader[:10].shape == (10, 10)
@@ -276,3 +503,179 @@ def test_waveform_extractor(tempdir, arr, traces, sample_rate, do_export, do_cac
 
     assert np.all(w[4, -5:, :] == 0)
     ac(w[4, :-5, :], data[-15:, [1, 3, 5]])
+
+
+def test_split_bounds():
+    assert _split_bounds([0, 10], 3) == [0, 3, 6, 9, 10]
+    assert _split_bounds([0, 2, 10], 4) == [0, 2, 6, 10]
+    assert _split_bounds([0, 2, 10], 10) == [0, 2, 10]
+
+
+def test_group_windows():
+    t0 = np.array([0, 5, 8, 30, 31, 100])
+    t1 = t0 + 10
+    ae(_group_windows(t0, t1), [0, 3, 5])
+    ae(_group_windows(t0, t1, max_gap=15), [0, 5])
+    ae(_group_windows(t0, t1, max_gap=100), [0])
+    ae(_group_windows(t0, t1, max_gap=100, max_length=30), [0, 3, 5])
+    ae(_group_windows(t0, t1, max_gap=100, bounds=[0, 20, 200]), [0, 3])
+    ae(_group_windows(t0[:0], t1[:0]), [])
+
+
+@mark.parametrize('window_size', [10, 2 ** 22])
+def test_extract_waveforms_batch(traces, window_size, monkeypatch):
+    import phylib.io.traces
+    monkeypatch.setattr(phylib.io.traces, 'WAVEFORM_WINDOW_SIZE', window_size)
+
+    nsw = 20
+    # Unsorted and duplicate spikes, on the edges of the data.
+    spike_samples = np.array([1000, 5, 1995, 25, 1000, 0, 1010, 26])
+    channel_ids = np.array([3, -1, 1, 5])
+    n = len(spike_samples)
+
+    def _expected(channels):
+        return np.stack([
+            _extract_waveform(traces, s, channel_ids=c, n_samples_waveforms=nsw)
+            for s, c in zip(spike_samples, channels)])
+
+    w = extract_waveforms(traces, spike_samples, channel_ids, n_samples_waveforms=nsw)
+    ae(w, _expected([channel_ids] * n))
+    assert np.all(w[..., 1] == 0)
+
+    # Different channels for every spike.
+    spike_channels = np.random.randint(-1, traces.shape[1], (n, 3))
+    w = _extract_waveforms(traces, spike_samples, spike_channels, n_samples_waveforms=nsw)
+    ae(w, _expected(spike_channels))
+
+    assert extract_waveforms(traces, [], channel_ids, n_samples_waveforms=nsw).shape == (0, nsw, 4)
+
+
+@mark.parametrize('sample2unit', [None, 1, .5])
+def test_export_waveforms_threads(tempdir, traces, sample2unit):
+    nsw = 20
+    spike_samples = np.array([5, 25, 100, 1000, 1001, 1500, 1995])
+    spike_channels = np.random.randint(-1, traces.shape[1], (len(spike_samples), 3))
+
+    export_waveforms(
+        tempdir / 'w0.npy', traces, spike_samples, spike_channels,
+        n_samples_waveforms=nsw, sample2unit=sample2unit)
+    export_waveforms(
+        tempdir / 'w1.npy', traces, spike_samples, spike_channels,
+        n_samples_waveforms=nsw, sample2unit=sample2unit, n_threads=3)
+    w0, w1 = np.load(tempdir / 'w0.npy'), np.load(tempdir / 'w1.npy')
+    assert w0.dtype == w1.dtype
+    ae(w0, w1)
+
+    expected = extract_waveforms(traces, spike_samples[:1], spike_channels[0], nsw)[0]
+    ac(w1[0], expected * (sample2unit if sample2unit is not None else 1))
+
+
+def test_prefetch_reader(traces, arr):
+    reader = PrefetchEphysReader(traces, n_chunks=2, chunk_duration=.05)
+    assert reader.n_samples == traces.n_samples
+    assert reader.chunk_bounds[0] == 0 and reader.chunk_bounds[-1] == traces.n_samples
+    assert np.all(np.diff(reader.chunk_bounds) <= max(1, round(.05 * traces.sample_rate)))
+
+    # Sequential access.
+    for i0, i1 in reader.iter_chunks():
+        ac(reader[i0:i1], arr[i0:i1])
+    if reader.n_chunks >= 3:
+        assert reader.hits > 0
+
+    # Random access and overlapping requests.
+    for i0 in np.random.randint(0, traces.n_samples - 1, 20):
+        i1 = min(traces.n_samples, i0 + np.random.randint(1, 300))
+        ac(reader[i0:i1], arr[i0:i1])
+    ac(reader[5], arr[[5]])
+
+    # Operations.
+    ac((reader[:, [1, 3]] * 2)[10:20], arr[10:20, [1, 3]] * 2)
+
+    w = extract_waveforms(reader, [5, 100, 1995], [1, 3], n_samples_waveforms=20)
+    ae(w, extract_waveforms(traces, [5, 100, 1995], [1, 3], n_samples_waveforms=20))
+
+    reader.close()
+
+
+def test_prefetch_get_ephys_reader(tempdir, arr):
+    path = tempdir / 'data.bin'
+    arr.tofile(path)
+    reader = get_ephys_reader(
+        path, sample_rate=1000, dtype=arr.dtype, n_channels=arr.shape[1], prefetch=3)
+    assert isinstance(reader, PrefetchEphysReader)
+    assert reader.n_chunks_ahead == 3
+    ac(reader[:], arr)
+    reader.close()
+
+
+@mark.parametrize('kwargs', [
+    dict(low=100.), dict(low=100., high=400.), dict(high=300., causal=True),
+    dict(low=100., reference='median'), dict(reference='mean')])
+def test_filtered_reader(kwargs):
+    arr = np.random.RandomState(0).randn(5000, 8).astype(np.float32)
+    reader = get_ephys_reader(arr, sample_rate=1000.).filter(**kwargs)
+    assert isinstance(reader, FilteredEphysReader)
+    assert reader.shape == arr.shape
+    assert reader.dtype == np.float32
+
+    # Expected data: the whole recording filtered at once.
+    expected = arr.copy()
+    if reader.sos is not None:
+        f = signal.sosfilt if reader.causal else signal.sosfiltfilt
+        expected = f(reader.sos, expected, axis=0)
+    if reader.reference == 'median':
+        expected -= np.median(expected, axis=1)[:, np.newaxis]
+    elif reader.reference == 'mean':
+        expected -= expected.mean(axis=1)[:, np.newaxis]
+
+    def _a(x, y):
+        ac(x, y, atol=1e-4 * np.abs(expected).max())
+
+    # Chunks at the edges and in the middle of the recording.
+    for i0, i1 in [(0, 100), (1000, 1500), (4900, 5000), (2000, 2001), (0, 5000)]:
+        _a(reader[i0:i1], expected[i0:i1])
+    _a(np.vstack([reader[i0:i0 + 500] for i0 in range(0, 5000, 500)]), expected)
+
+    _a(reader[10], expected[10:11])
+    _a(reader[[3000, 4, 2, 10]], expected[[3000, 4, 2, 10]])
+    _a(reader[:, [5, 1]][100:200], expected[100:200, [5, 1]])
+    _a((reader * 2)[:, 1:3][100:200], expected[100:200, 1:3] * 2)
+
+
+def test_filtered_reader_margin():
+    # The impulse response of a low cutoff filter is longer than one second.
+    arr = np.random.RandomState(0).randn(20000, 2).astype(np.float32)
+    reader = get_ephys_reader(arr, sample_rate=1000.).filter(low=.5, max_margin=10.)
+    assert reader.margin > 1000
+    expected = signal.sosfiltfilt(reader.sos, arr, axis=0)
+    ac(reader[8000:8100], expected[8000:8100], atol=1e-4 * np.abs(expected).max())
+
+    # Warning when the impulse response does not decay within the maximum margin.
+    with captured_logging('phylib.io.traces') as buf:
+        reader = get_ephys_reader(arr, sample_rate=1000.).filter(low=.5)
+    assert reader.margin == 1000
+    assert 'does not decay' in buf.getvalue()
+
+
+def test_filtered_reader_dtype(arr):
+    reader = get_ephys_reader((arr * 100).astype(np.int16), sample_rate=1000.)
+    # The data type follows the lazy operations of the wrapped reader.
+    views = [
+        (reader.filter(low=50.), np.float32),
+        ((reader * 1.5).filter(low=50.), np.float64),
+        ((reader * 1.5).subset_time_range((0, .05)), np.float64),
+    ]
+    for view, dtype in views:
+        assert view.dtype == dtype
+        assert view[:10].dtype == dtype
+        assert view.read_windows([0, 10], 5).dtype == dtype
+
+
+def test_filtered_reader_int(arr):
+    arr = (arr * 100).astype(np.int16)
+    reader = get_ephys_reader(arr, sample_rate=1000.)[:, [0, 2]].filter(low=50.)
+    assert reader.dtype == np.float32
+    assert reader.n_channels == 2
+    assert reader.margin > 0
+    expected = signal.sosfiltfilt(reader.sos, arr[:, [0, 2]].astype(np.float32), axis=0)
+    ac(reader[:], expected, rtol=1e-5, atol=1e-3)
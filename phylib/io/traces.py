@@ -7,6 +7,8 @@
 # Imports
 #------------------------------------------------------------------------------
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import copy
 import logging
 from functools import reduce
@@ -14,10 +16,12 @@ from math import ceil
 import multiprocessing as mp
 from operator import mul
 from pathlib import Path
+from threading import Lock
 
 import numpy as np
 from numpy.lib.format import (
-    _check_version, _write_array_header, dtype_to_descr)
+    _check_version, _write_array_header, dtype_to_descr, open_memmap)
+from scipy import signal
 import mtscomp
 from tqdm import tqdm
 
@@ -33,6 +37,10 @@ DEFAULT_CHUNK_DURATION = 600.0  # seconds
 EPHYS_RAW_EXTENSIONS = ('.dat', '.bin', '.raw', '.mda')
 
 
+# Maximum number of values in a window of data read at once when extracting waveforms.
+WAVEFORM_WINDOW_SIZE = 2 ** 22
+
+
 #------------------------------------------------------------------------------
 # Utils
 #------------------------------------------------------------------------------
@@ -145,6 +153,15 @@ def _get_chunk_bounds(arr_sizes, chunk_size):
     return b
 
 
+def _split_bounds(bounds, max_size):
+    """Split chunks given by their bounds so that no chunk is larger than `max_size`."""
+    assert max_size > 0
+    out = [bounds[0]]
+    for i0, i1 in zip(bounds[:-1], bounds[1:]):
+        out.extend(list(range(i0 + max_size, i1, max_size)) + [i1])
+    return out
+
+
 def _apply_op(op, arg, arr):
     if op == 'cols':
         return arr[:, arg]
@@ -152,6 +169,96 @@ def _apply_op(op, arg, arr):
     return f(arg) if arg is not None else f()
 
 
+# Reflected operations computed with a ufunc writing into the left operand.
+_REFLECTED_UFUNCS = {
+    'radd': np.add, 'rsub': np.subtract, 'rmul': np.multiply, 'rtruediv': np.true_divide,
+    'rfloordiv': np.floor_divide, 'rpow': np.power,
+}
+
+
+def _compile_ops(ops, n_cols):
+    """Reorder a list of operations so that all column selections are done first.
+
+    Return the combined column index (None if there is no column selection) and the list of
+    the other operations, with their per-column arguments subset accordingly. Return None if
+    the operations cannot be reordered.
+
+    """
+    cols = None
+    other = []
+    for op, arg in ops:
+        if op != 'cols':
+            other.append((op, arg))
+            continue
+        if np.ndim(arg) == 0 and not isinstance(arg, slice):
+            # Selecting a single column changes the number of dimensions.
+            return
+        index = np.arange(n_cols)[arg]
+        # Subset the per-column arguments of the previous operations.
+        for i, (op_, arg_) in enumerate(other):
+            if np.ndim(arg_) == 0 or np.shape(arg_)[-1] == 1:
+                continue
+            if np.shape(arg_)[-1] != n_cols:
+                return
+            other[i] = (op_, np.asarray(arg_)[..., index])
+        cols = index if cols is None else cols[index]
+        n_cols = len(index)
+    if cols is not None and len(cols) and np.all(np.diff(cols) == 1):
+        # Contiguous columns: take a view instead of a copy.
+        cols = slice(cols[0], cols[-1] + 1)
+    return cols, other
+
+
+def _apply_ops_inplace(ops, arr):
+    """Apply a list of arithmetic operations to an array that is owned by the caller.
+
+    The operations are computed in place, except when they change the data type, in which case
+    a new array is allocated. The result is the same as applying the operations one after the
+    other.
+
+    """
+    for op, arg in ops:
+        # The data type of the output is found with the same casting rules as the operation
+        # itself. Arguments with one value per row do not broadcast with an empty array.
+        if np.ndim(arg) >= 2 or _apply_op(op, arg, arr[:0]).dtype != arr.dtype:
+            arr = _apply_op(op, arg, arr)
+        elif op in _REFLECTED_UFUNCS:
+            _REFLECTED_UFUNCS[op](arg, arr, out=arr)
+        elif op == 'neg':
+            np.negative(arr, out=arr)
+        elif op != 'pos':
+            arr = getattr(arr, '__i%s__' % op)(arg)
+    return arr
+
+
+def _subset_bounds(bounds, start, stop):
+    """Return the bounds within the [start, stop) interval, relative to start."""
+    return [0] + [int(b) - start for b in bounds if start < b < stop] + [stop - start]
+
+
+def _n_output_channels(reader):
+    """Return the number of channels returned by a reader, taking its lazy column selection
+    into account."""
+    compiled = _compile_ops(reader._ops, reader.n_channels)
+    if compiled is None:  # pragma: no cover
+        return reader[:1].shape[1]
+    cols = compiled[0]
+    return len(np.arange(reader.n_channels)[cols]) if cols is not None else reader.n_channels
+
+
+def _output_dtype(reader):
+    """Return the data type of the data returned by a reader, taking its lazy operations into
+    account."""
+    return reader._apply_ops(np.zeros((0, reader.n_channels), dtype=reader.dtype)).dtype
+
+
+def _take(arr, rows, cols):
+    """Return the given rows and columns of an array, indexing the two axes independently."""
+    if isinstance(rows, np.ndarray) and not isinstance(cols, slice):
+        return arr[np.ix_(rows, cols)]
+    return arr[rows, cols]
+
+
 def _memmap_flat(path, dtype=None, n_channels=None, offset=0, mode='r+'):
     path = Path(path)
     # Find the number of samples.
@@ -193,7 +300,6 @@ class BaseEphysReader(object):
 
     @property
     def n_samples(self):
-        # TODO: take subset interval into account
         return self.chunk_bounds[-1]
 
     @property
@@ -212,6 +318,18 @@ class BaseEphysReader(object):
         """Return the requested item[] of a part of the data. To be overriden."""
         raise NotImplementedError()
 
+    def _get_part_cols(self, part_idx, subitem, cols):
+        """Return the requested item[] of a subset of the channels of a part of the data.
+        May be overriden by readers that can read a subset of the channels directly."""
+        return self._get_part(part_idx, subitem)[..., cols]
+
+    def _get_parts(self, subitems, cols=None):
+        """Return a list of arrays with the requested items of several parts of the data.
+        May be overriden by readers that can read several parts in parallel."""
+        if cols is None:
+            return [self._get_part(part_idx, subitem) for part_idx, subitem in subitems]
+        return [self._get_part_cols(part_idx, subitem, cols) for part_idx, subitem in subitems]
+
     def __getitem__(self, item):
         if isinstance(item, tuple):
             if len(item) == 1:  # pragma: no cover
@@ -221,21 +339,45 @@ class BaseEphysReader(object):
                 cols = item[1]
                 # NOTE the self = here.
                 self = self._append_op('cols', cols)
-                if item[0] == slice(None, None, None):
+                if isinstance(item[0], slice) and item[0] == slice(None, None, None):
                     # traces[:, cols] should return a cloned EphysReader instance.
                     return self
                 item = item[0]
             else:
                 raise NotImplementedError()
-        # TODO: take interval into account
-        # item = _subset_interval(interval, item)
-        to_concat = []
+        # Strided slices and index arrays are read as sorted unique indices, and the rows are
+        # then put back in the requested order.
+        inverse = None
+        if isinstance(item, slice) and item.step not in (None, 1):
+            item = np.arange(*item.indices(self.n_samples))
+        if isinstance(item, (list, np.ndarray)):
+            item = np.asarray(item)
+            if item.dtype == bool:
+                item = np.nonzero(item)[0]
+            item = item.astype(np.int64).ravel()
+            item[item < 0] += self.n_samples
+            if np.any((item < 0) | (item >= self.n_samples)):
+                raise IndexError("Index out of bounds for axis 0 with size %d." % self.n_samples)
+            if len(item) == 0:
+                return self._apply_ops(np.zeros((0, self.n_channels), dtype=self.dtype))
+            if np.any(np.diff(item) <= 0):
+                item, inverse = np.unique(item, return_inverse=True)
+        # Do the column selection first, so that only the requested channels are read.
+        compiled = _compile_ops(self._ops, self.n_channels)
+        if compiled is None:  # pragma: no cover
+            cols, ops = None, None
+        else:
+            cols, ops = compiled
         # Obtain the requested parts.
-        for part_idx, subitem in _get_subitems(self.part_bounds, item):
-            to_concat.append(self._get_part(part_idx, subitem))
+        to_concat = self._get_parts(_get_subitems(self.part_bounds, item), cols)
         # Concatenate the parts.
         out = np.vstack(to_concat)
-        return self._apply_ops(out)
+        if inverse is not None:
+            out = out[inverse]
+        if ops is None:  # pragma: no cover
+            return self._apply_ops(out)
+        # NOTE: out is a new array, the operations can be computed in place.
+        return _apply_ops_inplace(ops, out)
 
     def _append_op(self, op, arg=None):
         clone = copy.copy(self)
@@ -297,8 +439,41 @@ class BaseEphysReader(object):
     def __rpow__(self, arg):
         return self._append_op('rpow', arg)
 
+    def filter(
+            self, low=None, high=None, order=3, causal=False, reference=None, margin=None,
+            max_margin=1.):
+        """Return a lazily filtered version of the data, see `FilteredEphysReader`."""
+        return FilteredEphysReader(
+            self, low=low, high=high, order=order, causal=causal, reference=reference,
+            margin=margin, max_margin=max_margin)
+
+    def read_windows(self, starts, length, channels=None):
+        """Read windows of `length` samples starting at `starts`, on some channels (all
+        channels by default), and return a `(n_windows, length, n_channels)` array.
+
+        Nearby windows are read at once, and samples out of the data are filled with zeros.
+
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        if channels is None:
+            channels = np.arange(_n_output_channels(self))
+        channels = np.asarray(channels, dtype=np.int64)
+        out = np.zeros((len(starts), length, len(channels)), dtype=_output_dtype(self))
+        return _extract_waveforms(self, starts + length // 2, channels, length, out=out)
+
     def subset_time_range(self, interval):
-        raise NotImplementedError()
+        """Return a view on the data restricted to a [t0, t1) time interval in seconds,
+        see `SubsetEphysReader`."""
+        t0, t1 = interval
+        start = int(round(t0 * self.sample_rate))
+        stop = int(round(t1 * self.sample_rate))
+        return SubsetEphysReader(self, start, stop)
+
+    def close(self):
+        """Close the wrapped reader, if any."""
+        reader = getattr(self, 'reader', None)
+        if isinstance(reader, BaseEphysReader):
+            reader.close()
 
     def iter_chunks(self, cache=True):
         for i0, i1 in zip(self.chunk_bounds[:-1], self.chunk_bounds[1:]):
@@ -334,41 +509,116 @@ class FlatEphysReader(BaseEphysReader):
         """To be overriden."""
         return self._mmaps[part_idx][subitem]
 
+    def _get_part_cols(self, part_idx, subitem, cols):
+        return _take(self._mmaps[part_idx], subitem, cols)
+
 
 class MtscompEphysReader(BaseEphysReader):
-    def __init__(self, reader, **kwargs):
+    """EphysReader for one or several concatenated mtscomp compressed files.
+
+    Constructor
+    -----------
+
+    reader : mtscomp.Reader or list of mtscomp.Reader
+        The opened mtscomp readers.
+    chunk_cache : LRUCache
+        Cache of the decompressed chunks, which may be shared by several readers. By default,
+        the chunks are cached by the mtscomp readers.
+
+    """
+
+    def __init__(self, reader, chunk_cache=None, **kwargs):
         super(MtscompEphysReader, self).__init__()
-        if isinstance(reader, (tuple, list)):  # pragma: no cover
-            assert reader
-            # TODO: support concatenation of multiple .cbin files. Currently, only take the first.
-            if len(reader) >= 2:
-                logger.warning(
-                    "Support of multiple concatenate .cbin files is not supported yet. "
-                    "Taking the first file only.")
-            reader = reader[0]
-        assert isinstance(reader, mtscomp.Reader)
-        self.reader = reader
+        readers = list(reader) if isinstance(reader, (tuple, list)) else [reader]
+        assert readers
+        assert all(isinstance(reader, mtscomp.Reader) for reader in readers)
+        self.readers = readers
+        self.reader = reader = readers[0]
         self.name = reader.cdata.name
         self.dir_path = Path(self.name).parent
         self.sample_rate = reader.sample_rate
         self.dtype = reader.dtype
         self.n_channels = reader.n_channels
-        self.part_bounds = [0, reader.n_samples]  # TODO: support multiple concatenated readers
-        self.chunk_bounds = reader.chunk_bounds
+        for other in readers[1:]:
+            if (other.sample_rate, other.dtype, other.n_channels) != (
+                    self.sample_rate, self.dtype, self.n_channels):
+                raise ValueError(
+                    "The concatenated .cbin files should have the same sample rate, "
+                    "data type, and number of channels.")
+        self.part_bounds = _get_part_bounds(readers)
+        # Chunk bounds of all readers, in the concatenated time axis.
+        self.chunk_bounds = [0]
+        for offset, reader in zip(self.part_bounds, readers):
+            self.chunk_bounds.extend(offset + b for b in reader.chunk_bounds[1:])
+        # Thread pool used to decompress the data from several files in parallel.
+        self._executor = ThreadPoolExecutor(len(readers)) if len(readers) >= 2 else None
+        self.chunk_cache = chunk_cache
+
+    def close(self):
+        """Stop the decompression threads and close the files."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        for reader in self.readers:
+            reader.close()
+
+    def _read_chunk(self, part_idx, chunk_idx):
+        """Return a decompressed chunk of a file, from the chunk cache if possible."""
+        reader = self.readers[part_idx]
+        key = (reader.cdata.name, chunk_idx)
+        chunk = self.chunk_cache.get(key)
+        if chunk is None:
+            start, stop = reader.chunk_offsets[chunk_idx:chunk_idx + 2]
+            # NOTE: bypass the cache of the mtscomp reader to avoid keeping the chunk twice.
+            chunk = mtscomp.Reader.read_chunk(reader, chunk_idx, start, stop - start)
+            chunk.flags.writeable = False
+            self.chunk_cache.put(key, chunk)
+        return chunk
+
+    def _read(self, part_idx, start, stop):
+        """Return the [start, stop) samples of a file."""
+        reader = self.readers[part_idx]
+        if self.chunk_cache is None:
+            return reader[start:stop]
+        if stop <= start:
+            return np.zeros((0, self.n_channels), dtype=self.dtype)
+        first, last = _find_chunks(reader.chunk_bounds, [start, stop - 1])
+        chunks = [self._read_chunk(part_idx, chunk_idx) for chunk_idx in range(first, last + 1)]
+        data = np.concatenate(chunks) if len(chunks) > 1 else chunks[0]
+        offset = reader.chunk_bounds[first]
+        return data[start - offset:stop - offset]
 
     def _get_part(self, part_idx, subitem):
-        assert part_idx == 0
-        return self.reader[subitem]
+        reader = self.readers[part_idx]
+        if isinstance(subitem, slice):
+            return self._read(part_idx, subitem.start, subitem.stop)
+        elif not isinstance(subitem, np.ndarray):
+            return self._read(part_idx, int(subitem), int(subitem) + 1)[0]
+        # NOTE: mtscomp does not support fancy indexing, so we read the requested samples
+        # chunk by chunk, and every chunk is decompressed once.
+        out = np.empty((len(subitem), self.n_channels), dtype=self.dtype)
+        firsts = _group_windows(
+            subitem, subitem + 1, max_gap=reader.n_samples, bounds=reader.chunk_bounds)
+        for first, last in zip(firsts, np.r_[firsts[1:], len(subitem)]):
+            start, stop = int(subitem[first]), int(subitem[last - 1]) + 1
+            out[first:last] = self._read(part_idx, start, stop)[subitem[first:last] - start]
+        return out
 
-    def iter_chunks(self, cache=True):
-        """Iterate over multiple chunks that are decompressed in parallel."""
-        reader = self.reader
+    def _get_parts(self, subitems, cols=None):
+        if self._executor is None or len(subitems) <= 1:
+            return super(MtscompEphysReader, self)._get_parts(subitems, cols)
+        if cols is None:
+            return list(self._executor.map(lambda s: self._get_part(*s), subitems))
+        return list(self._executor.map(lambda s: self._get_part_cols(*s, cols), subitems))
 
+    def _iter_reader_chunks(self, part_idx, cache=True):
+        """Iterate over multiple chunks of a file that are decompressed in parallel."""
+        reader = self.readers[part_idx]
         if cache:
             # Create the thread pool.
             reader.start_thread_pool()
-            # Make sure all chunks from a batch are cached.
-            reader.set_cache_size(reader.n_batches + 2)
+            if self.chunk_cache is None:
+                # Make sure all chunks from a batch are cached.
+                reader.set_cache_size(reader.n_batches + 2)
 
         for batch in range(reader.n_batches):
             first_chunk = reader.batch_size * batch  # first included
@@ -381,7 +631,12 @@ class MtscompEphysReader(BaseEphysReader):
                     batch + 1,
                     reader.n_batches, ', '.join(map(str, range(first_chunk, last_chunk))))
                 # Decompress all chunks in the batch.
-                reader.decompress_chunks(range(first_chunk, last_chunk), reader.pool)
+                if self.chunk_cache is None:
+                    reader.decompress_chunks(range(first_chunk, last_chunk), reader.pool)
+                else:
+                    reader.pool.map(
+                        lambda chunk_idx: self._read_chunk(part_idx, chunk_idx),
+                        range(first_chunk, last_chunk))
 
             # Do not include the last chunk so as to cache the next chunk (useful when extracting
             # waveforms).
@@ -395,6 +650,12 @@ class MtscompEphysReader(BaseEphysReader):
         if cache:
             reader.stop_thread_pool()
 
+    def iter_chunks(self, cache=True):
+        """Iterate over multiple chunks that are decompressed in parallel."""
+        for part_idx, offset in enumerate(self.part_bounds[:-1]):
+            for i0, i1 in self._iter_reader_chunks(part_idx, cache=cache):
+                yield offset + i0, offset + i1
+
 
 class ArrayEphysReader(BaseEphysReader):
     def __init__(self, arr, **kwargs):
@@ -412,6 +673,10 @@ class ArrayEphysReader(BaseEphysReader):
         assert part_idx == 0
         return self._arr[subitem]
 
+    def _get_part_cols(self, part_idx, subitem, cols):
+        assert part_idx == 0
+        return _take(self._arr, subitem, cols)
+
 
 class NpyEphysReader(ArrayEphysReader):
     def __init__(self, path, **kwargs):
@@ -445,6 +710,291 @@ class RandomEphysReader(BaseEphysReader):
         return np.random.randn(n, self.n_channels).astype(np.float32)
 
 
+class PrefetchEphysReader(BaseEphysReader):
+    """Wrapper around an EphysReader that reads the next chunks in a background thread while
+    the current ones are being used, so that sequential access overlaps I/O and decompression
+    with computations.
+
+    Constructor
+    -----------
+
+    reader : BaseEphysReader
+        The EphysReader instance to wrap.
+    n_chunks : int
+        Number of chunks read ahead.
+    chunk_duration : float
+        Maximum duration, in seconds, of the chunks read at once. The chunks of the wrapped
+        reader are split if they are longer.
+
+    """
+
+    def __init__(self, reader, n_chunks=2, chunk_duration=1., **kwargs):
+        super(PrefetchEphysReader, self).__init__()
+        assert n_chunks > 0
+        self.reader = reader
+        self.n_chunks_ahead = n_chunks
+        self.name = reader.name
+        self.dir_path = reader.dir_path
+        self.sample_rate = reader.sample_rate
+        self.dtype = reader.dtype
+        self.n_channels = reader.n_channels
+        self.part_bounds = [0, reader.n_samples]
+        self.chunk_bounds = _split_bounds(
+            list(reader.chunk_bounds), max(1, int(round(chunk_duration * self.sample_rate))))
+        # Chunks being read or already read, {chunk_idx: future}.
+        self._chunks = OrderedDict()
+        self._lock = Lock()
+        self._executor = ThreadPoolExecutor(1)
+        self.hits = 0
+        self.misses = 0
+
+    def _read_chunk(self, chunk_idx):
+        i0, i1 = self.chunk_bounds[chunk_idx:chunk_idx + 2]
+        return self.reader[i0:i1]
+
+    def _prefetch(self, first, last):
+        """Read the chunks after the requested ones in the background, and discard the chunks
+        that are no longer needed."""
+        with self._lock:
+            upcoming = range(last + 1, min(last + 1 + self.n_chunks_ahead, self.n_chunks))
+            for chunk_idx in upcoming:
+                if chunk_idx not in self._chunks:
+                    self._chunks[chunk_idx] = self._executor.submit(self._read_chunk, chunk_idx)
+            # NOTE: keep the previous chunk, in case of overlapping requests as with waveforms.
+            for chunk_idx in list(self._chunks):
+                if not (first - 1 <= chunk_idx <= last + self.n_chunks_ahead):
+                    del self._chunks[chunk_idx]
+            futures = [self._chunks.get(chunk_idx) for chunk_idx in range(first, last + 1)]
+        return futures
+
+    def _get_chunk(self, chunk_idx, future):
+        if future is None:
+            self.misses += 1
+            return self._read_chunk(chunk_idx)
+        self.hits += 1
+        return future.result()
+
+    def _get_part(self, part_idx, subitem):
+        assert part_idx == 0
+        if not isinstance(subitem, slice) or subitem.stop <= subitem.start:
+            return self.reader[subitem]
+        start, stop = subitem.start, subitem.stop
+        first, last = _find_chunks(self.chunk_bounds, [start, stop - 1])
+        futures = self._prefetch(first, last)
+        chunks = [
+            self._get_chunk(chunk_idx, future)
+            for chunk_idx, future in zip(range(first, last + 1), futures)]
+        data = np.vstack(chunks) if len(chunks) > 1 else chunks[0]
+        offset = self.chunk_bounds[first]
+        return data[start - offset:stop - offset]
+
+    def close(self):
+        """Stop the background thread, discard the chunks read ahead, and close the wrapped
+        reader."""
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            self._chunks.clear()
+        super(PrefetchEphysReader, self).close()
+
+
+def _filter_margin(sos, n_samples, tol=1e-5, max_samples=None):
+    """Return the number of samples after which the L1 norm of the rest of the impulse response
+    of a filter is below `tol` times the norm of the whole response.
+
+    The response is computed on `n_samples` samples, which are doubled until the response has
+    decayed, up to `max_samples`.
+
+    """
+    n_samples = min(n_samples, max_samples) if max_samples is not None else n_samples
+    while True:
+        impulse = np.zeros(n_samples)
+        impulse[0] = 1
+        # L1 norm of the end of the response, from every sample.
+        tail = np.cumsum(np.abs(signal.sosfilt(sos, impulse))[::-1])[::-1]
+        margin = int(np.nonzero(tail > tol * tail[0])[0][-1]) + 1
+        # The response must have decayed on a large part of the window.
+        if margin <= n_samples // 2:
+            return margin
+        if max_samples is not None and n_samples >= max_samples:
+            logger.warning(
+                "The impulse response of the filter does not decay below %.1e of its norm "
+                "within %d samples, the filtered data may be inaccurate.", tol, n_samples)
+            return margin
+        n_samples = 2 * n_samples if max_samples is None else min(2 * n_samples, max_samples)
+
+
+class FilteredEphysReader(BaseEphysReader):
+    """Wrapper around an EphysReader that filters the data on the fly, with a Butterworth
+    filter followed by a common reference.
+
+    The data is never filtered as a whole: every request is read with a margin on both sides
+    (on the left side only for a causal filter), which is filtered and then discarded. With the
+    default margin, the result matches filtering the whole recording up to a relative error
+    below 1e-4.
+
+    Constructor
+    -----------
+
+    reader : BaseEphysReader
+        The EphysReader instance to wrap.
+    low : float
+        High-pass cutoff frequency, in Hz.
+    high : float
+        Low-pass cutoff frequency, in Hz.
+    order : int
+        Order of the Butterworth filter.
+    causal : boolean
+        Whether to use a causal filter, instead of a zero-phase forward-backward filter.
+    reference : str
+        `'median'` or `'mean'` to subtract the median or mean across channels at every sample.
+    margin : int
+        Number of samples read on each side of the requests. By default, this is the length
+        of the impulse response of the filter, up to `max_margin`.
+    max_margin : float
+        Maximum duration, in seconds, of the default margin. Every request reads this much
+        additional data on each side, on all channels, so that filters with a low cutoff
+        frequency make small reads, like waveforms, much more expensive. A warning is logged
+        when the impulse response is truncated, in which case the result is less accurate.
+
+    The data type is the one of the wrapped reader, after its lazy operations, or float32 for
+    integer data.
+
+    """
+
+    def __init__(
+            self, reader, low=None, high=None, order=3, causal=False, reference=None,
+            margin=None, max_margin=1., **kwargs):
+        super(FilteredEphysReader, self).__init__()
+        assert reference in (None, 'median', 'mean')
+        self.reader = reader
+        self.name = reader.name
+        self.dir_path = reader.dir_path
+        self.sample_rate = reader.sample_rate
+        self.dtype = np.result_type(_output_dtype(reader), np.float32)
+        self.n_channels = _n_output_channels(reader)
+        self.part_bounds = [0, reader.n_samples]
+        self.chunk_bounds = reader.chunk_bounds
+        self.causal = causal
+        self.reference = reference
+        if low and high:
+            self.sos = signal.butter(
+                order, (low, high), 'bandpass', fs=self.sample_rate, output='sos')
+        elif low or high:
+            self.sos = signal.butter(
+                order, low or high, 'highpass' if low else 'lowpass', fs=self.sample_rate,
+                output='sos')
+        else:
+            self.sos = None
+        if margin is None and self.sos is not None:
+            # Start from ten periods of the lowest cutoff frequency.
+            margin = _filter_margin(
+                self.sos, int(ceil(10 * self.sample_rate / min(f for f in (low, high) if f))),
+                max_samples=max(1, int(max_margin * self.sample_rate)))
+        self.margin = margin or 0
+
+    def _filter(self, data, cols=None):
+        data = data.astype(self.dtype, copy=False)
+        if self.sos is not None and len(data) > 0:
+            if self.causal:
+                data = signal.sosfilt(self.sos, data, axis=0)
+            else:
+                # NOTE: use the default padding, unless the data is too short.
+                padlen = None if len(data) > 3 * (2 * len(self.sos) + 1) else len(data) - 1
+                data = signal.sosfiltfilt(self.sos, data, axis=0, padlen=padlen)
+            data = data.astype(self.dtype, copy=False)
+        if self.reference == 'median':
+            data -= np.median(data, axis=1)[:, np.newaxis]
+        elif self.reference == 'mean':
+            data -= data.mean(axis=1)[:, np.newaxis]
+        return data[:, cols] if cols is not None else data
+
+    def _read(self, start, stop, cols=None):
+        """Read and filter the data between two samples."""
+        # NOTE: the reference is computed across all channels.
+        cols_read = cols if self.reference is None else None
+        i0 = max(0, start - self.margin)
+        i1 = min(self.n_samples, stop + (self.margin if not self.causal else 0))
+        reader = self.reader[:, cols_read] if cols_read is not None else self.reader
+        data = self._filter(reader[i0:i1], cols=cols if cols_read is None else None)
+        return data[start - i0:stop - i0]
+
+    def _get_part_cols(self, part_idx, subitem, cols):
+        assert part_idx == 0
+        if isinstance(subitem, slice):
+            return self._read(subitem.start, subitem.stop, cols=cols)
+        elif isinstance(subitem, (int, np.integer)):
+            return self._read(subitem, subitem + 1, cols=cols)[0]
+        # Read the requested samples in groups of nearby samples.
+        order = np.argsort(subitem, kind='stable')
+        samples = np.asarray(subitem)[order]
+        n = self.n_channels if cols is None else len(np.arange(self.n_channels)[cols])
+        out = np.empty((len(samples), n), dtype=self.dtype)
+        firsts = _group_windows(samples, samples + 1, max_gap=2 * self.margin)
+        for first, last in zip(firsts, np.r_[firsts[1:], len(samples)]):
+            start, stop = samples[first], samples[last - 1] + 1
+            out[order[first:last]] = self._read(start, stop, cols=cols)[
+                samples[first:last] - start]
+        return out
+
+    def _get_part(self, part_idx, subitem):
+        return self._get_part_cols(part_idx, subitem, None)
+
+    def iter_chunks(self, cache=True):
+        return self.reader.iter_chunks(cache=cache)
+
+
+class SubsetEphysReader(BaseEphysReader):
+    """View on the [start, stop) samples of an EphysReader.
+
+    The view shares the memmaps or mtscomp readers of the wrapped reader and does not copy
+    any data. `sample_onset` and `sample_offset` are the bounds of the view in the wrapped
+    reader.
+
+    Constructor
+    -----------
+
+    reader : BaseEphysReader
+        The EphysReader instance to wrap.
+    start : int
+        First sample of the view, included.
+    stop : int
+        Last sample of the view, excluded.
+
+    """
+
+    def __init__(self, reader, start, stop, **kwargs):
+        super(SubsetEphysReader, self).__init__()
+        start = max(0, min(start, reader.n_samples))
+        stop = max(start, min(stop, reader.n_samples))
+        if isinstance(reader, SubsetEphysReader) and not reader._ops:
+            # Avoid nested views.
+            start, stop = start + reader.sample_onset, stop + reader.sample_onset
+            reader = reader.reader
+        self.reader = reader
+        self.name = reader.name
+        self.dir_path = reader.dir_path
+        self.sample_rate = reader.sample_rate
+        self.dtype = _output_dtype(reader)
+        self.n_channels = _n_output_channels(reader)
+        self.sample_onset = start
+        self.sample_offset = stop
+        self.part_bounds = _subset_bounds(reader.part_bounds, start, stop)
+        self.chunk_bounds = _subset_bounds(reader.chunk_bounds, start, stop)
+
+    def _get_part_cols(self, part_idx, subitem, cols):
+        # Part index and subitem relative to the wrapped reader.
+        offset = self.sample_onset + self.part_bounds[part_idx]
+        if isinstance(subitem, slice):
+            subitem = slice(offset + subitem.start, offset + subitem.stop)
+        else:
+            subitem = offset + subitem
+        reader = self.reader[:, cols] if cols is not None else self.reader
+        return reader[subitem]
+
+    def _get_part(self, part_idx, subitem):
+        return self._get_part_cols(part_idx, subitem, None)
+
+
 #------------------------------------------------------------------------------
 # High-level functions
 #------------------------------------------------------------------------------
@@ -466,7 +1016,7 @@ def _get_ephys_constructor(obj, **kwargs):
         assert ext, "No extension found in file `%s`" % path
         # Mtscomp file
         if ext == '.cbin':
-            reader = mtscomp.Reader(n_threads=mp.cpu_count() // 2)
+            reader = mtscomp.Reader(n_threads=max(1, mp.cpu_count() // 2))
             reader.open(path)
             return (MtscompEphysReader, reader, kwargs)
         # Flat binary file
@@ -490,13 +1040,20 @@ def _get_ephys_constructor(obj, **kwargs):
 def get_ephys_reader(obj, **kwargs):
     """Get an EphysReader instance from any NumPy-like object of file path.
 
+    If `prefetch` is a positive number of chunks, return a PrefetchEphysReader that reads these
+    chunks ahead in a background thread.
+
     Return None if data file(s) not available.
 
     """
+    prefetch = kwargs.pop('prefetch', 0)
     klass, arg, kwargs = _get_ephys_constructor(obj, **kwargs)
     if not klass:
         return
-    return klass(arg, **kwargs)
+    reader = klass(arg, **kwargs)
+    if prefetch:
+        reader = PrefetchEphysReader(reader, n_chunks=prefetch)
+    return reader
 
 
 #------------------------------------------------------------------------------
@@ -520,15 +1077,21 @@ def get_spike_waveforms(spike_ids, channel_ids, spike_waveforms=None, n_samples_
     nc = len(channel_ids)
     assert nc > 0
     out = np.zeros((ns, nsw, nc), dtype=spike_waveforms.waveforms.dtype)
+    if ns == 0:
+        return out
+    # Lookup table from the channels to the requested columns.
+    channel_ids = np.asarray(channel_ids, dtype=np.int64)
+    spike_channels = np.asarray(spike_waveforms.spike_channels[spike_ids_rel], dtype=np.int64)
+    m = max(channel_ids.max(), spike_channels.max()) + 1
+    lookup = np.full(m + 1, -1, dtype=np.int64)
+    lookup[channel_ids[channel_ids >= 0]] = np.nonzero(channel_ids >= 0)[0]
+    # Requested column of every column of the precomputed waveforms, -1 if not requested.
+    # NOTE: -1 channels map to the last, unused, item of the lookup table.
+    cols = lookup[spike_channels]
+    i, j = np.nonzero(cols >= 0)
     # Extract the spike waveforms.
-    for i, sid in enumerate(spike_ids_rel):
-        ind = spike_waveforms.spike_channels[sid, :]
-        channel_common = np.intersect1d(channel_ids, ind)
-        if len(channel_ids) > 0:
-            cols0 = _index_of(channel_common, channel_ids)
-            cols1 = _index_of(channel_common, ind)
-            assert len(cols0) == len(cols1)
-            out[i, :, cols0] = spike_waveforms.waveforms[sid, :, cols1]
+    waveforms = spike_waveforms.waveforms[spike_ids_rel]
+    out[i, :, cols[i, j]] = waveforms[i, :, j]
     return out
 
 
@@ -598,19 +1161,96 @@ def _extract_waveform(traces, sample, channel_ids=None, n_samples_waveforms=None
     return w
 
 
+def _group_windows(t0, t1, max_gap=0, max_length=None, bounds=None):
+    """Group sorted [t0, t1) windows that are less than `max_gap` samples apart, so that each
+    group can be read at once.
+
+    Groups are at most about `max_length` samples long and do not start in different chunks if
+    chunk `bounds` are specified. Return the index of the first window of every group.
+
+    """
+    n = len(t0)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    # End of the windows read so far.
+    ends = np.maximum.accumulate(t1)
+    new = np.r_[True, t0[1:] > ends[:-1] + max_gap]
+    if bounds is not None:
+        chunks = _find_chunks(bounds, t0)
+        new[1:] |= chunks[1:] != chunks[:-1]
+    if max_length:
+        # Split the groups that are too long.
+        group = np.cumsum(new) - 1
+        sub = (t0 - t0[new][group]) // max_length
+        new[1:] |= sub[1:] != sub[:-1]
+    return np.nonzero(new)[0]
+
+
+def _extract_waveforms(traces, spike_samples, channel_ids, n_samples_waveforms=None, out=None):
+    """Extract spike waveforms by reading one window of data for every group of nearby spikes.
+
+    `channel_ids` is either a 1D array with the channels of all spikes, or a 2D array with
+    the channels of every spike. Channels -1 and samples out of the data are filled with
+    zeros.
+
+    """
+    spike_samples = np.asarray(spike_samples).astype(np.int64)
+    channel_ids = np.asarray(channel_ids, dtype=np.int64)
+    ns = len(spike_samples)
+    nsw = n_samples_waveforms
+    nc = channel_ids.shape[-1]
+    per_spike = channel_ids.ndim == 2
+    assert not per_spike or channel_ids.shape[0] == ns
+    if out is None:
+        out = np.zeros((ns, nsw, nc), dtype=traces.dtype)
+    assert out.shape == (ns, nsw, nc)
+    if ns == 0:
+        return out
+    dur = traces.shape[0]
+    a = nsw // 2
+    order = np.argsort(spike_samples, kind='stable')
+    t0 = spike_samples[order] - a
+    t1 = t0 + nsw
+    # Read windows of a bounded size.
+    n_read = traces.shape[1] if per_spike else nc
+    max_length = max(nsw, WAVEFORM_WINDOW_SIZE // max(1, n_read))
+    starts = _group_windows(
+        t0, t1, max_gap=4 * nsw, max_length=max_length,
+        bounds=getattr(traces, 'chunk_bounds', None))
+    ends = np.r_[starts[1:], ns]
+    for i, j in zip(starts, ends):
+        w0 = max(0, t0[i])
+        w1 = min(dur, t1[i:j].max())
+        if w1 <= w0:
+            out[order[i:j]] = 0
+            continue
+        # Rows of the waveforms in the window, with the samples out of the data masked.
+        rows = (t0[i:j] - w0)[:, np.newaxis] + np.arange(nsw)
+        outside = (rows < 0) | (rows >= w1 - w0)
+        rows = np.clip(rows, 0, w1 - w0 - 1)
+        if per_spike:
+            window = traces[w0:w1]
+            cols = channel_ids[order[i:j]]
+            w = window[rows[:, :, np.newaxis], cols[:, np.newaxis, :]]
+            w[np.broadcast_to((cols == -1)[:, np.newaxis, :], w.shape)] = 0
+        else:
+            if isinstance(traces, BaseEphysReader):
+                # Only read the requested channels.
+                window = traces[:, channel_ids][w0:w1]
+            else:
+                window = traces[w0:w1][:, channel_ids]
+            w = window[rows]
+            w[..., channel_ids == -1] = 0
+        w[outside] = 0
+        out[order[i:j]] = w
+    return out
+
+
 def extract_waveforms(traces, spike_samples, channel_ids, n_samples_waveforms=None):
     """Extract waveforms for a given set of spikes, on certain channels."""
-    # Create the output array.
-    ns = len(spike_samples)
     nsw = n_samples_waveforms
     assert nsw > 0, "Please specify n_samples_waveforms > 0"
-    nc = len(channel_ids)
-    # Extract the spike waveforms.
-    out = np.zeros((ns, nsw, nc), dtype=traces.dtype)
-    for i, ts in enumerate(spike_samples):
-        out[i] = _extract_waveform(
-            traces, ts, channel_ids=channel_ids, n_samples_waveforms=nsw)[np.newaxis, ...]
-    return out
+    return _extract_waveforms(traces, spike_samples, channel_ids, n_samples_waveforms=nsw)
 
 
 def iter_waveforms(traces, spike_samples, spike_channels, n_samples_waveforms=None, cache=False):
@@ -636,31 +1276,68 @@ def iter_waveforms(traces, spike_samples, spike_channels, n_samples_waveforms=No
             continue
         # Extract the spike waveforms within the chunk.
         waveforms = np.zeros((ns, n_samples_waveforms, n_channels_loc), dtype=traces.dtype)
-        for i, ss in enumerate(ss):
-            channel_ids = sc[i, :]
-            waveforms[i, ...] = _extract_waveform(
-                traces, ss, channel_ids=channel_ids,
-                n_samples_waveforms=n_samples_waveforms)
-        yield waveforms
+        yield _extract_waveforms(
+            traces, ss, sc, n_samples_waveforms=n_samples_waveforms, out=waveforms)
     pb.close()
 
 
+def _export_waveforms_parallel(
+        path, traces, spike_samples, spike_channels, n_samples_waveforms=None, sample2unit=1,
+        dtype=None, n_threads=None):
+    """Extract the waveforms of every chunk in a thread pool, and write them into disjoint rows
+    of a preallocated npy file."""
+    n_spikes = len(spike_samples)
+    shape = (n_spikes, n_samples_waveforms, spike_channels.shape[1])
+    out = open_memmap(str(path), mode='w+', dtype=dtype, shape=shape)
+    # Same spike order as iter_waveforms(): by chunk, then in the original order.
+    chunks = _find_chunks(traces.chunk_bounds, spike_samples)
+    order = np.argsort(chunks, kind='stable')
+    chunk_ids, offsets = np.unique(chunks[order], return_index=True)
+    offsets = np.r_[offsets, n_spikes]
+
+    def _export_chunk(i):
+        ind = order[offsets[i]:offsets[i + 1]]
+        waveforms = _extract_waveforms(
+            traces, spike_samples[ind], spike_channels[ind],
+            n_samples_waveforms=n_samples_waveforms)
+        out[offsets[i]:offsets[i + 1]] = \
+            waveforms * sample2unit if sample2unit is not None else waveforms
+
+    with ThreadPoolExecutor(n_threads) as executor:
+        for _ in tqdm(executor.map(_export_chunk, range(len(chunk_ids))),
+                      desc="Extracting waveforms", total=len(chunk_ids)):
+            pass
+    out.flush()
+
+
 def export_waveforms(
         path, traces, spike_samples, spike_channels, n_samples_waveforms=None, cache=False,
-        sample2unit=1):
+        sample2unit=1, n_threads=None):
     """Export a selection of spike waveforms to a npy file by iterating over the data on a chunk
-    by chunk basis."""
+    by chunk basis.
+
+    If `n_threads` is specified, the chunks are processed concurrently in a thread pool. The
+    output file is the same.
+
+    """
     n_spikes = len(spike_samples)
+    spike_samples = np.asarray(spike_samples)
     spike_channels = np.asarray(spike_channels, dtype=np.int32)
     n_channels_loc = spike_channels.shape[1]
     shape = (n_spikes, n_samples_waveforms, n_channels_loc)
     dtype = traces.dtype if sample2unit is None else float
+    if n_threads and n_spikes:
+        return _export_waveforms_parallel(
+            path, traces, spike_samples, spike_channels, n_samples_waveforms=n_samples_waveforms,
+            sample2unit=sample2unit, dtype=dtype, n_threads=n_threads)
     writer = NpyWriter(path, shape, dtype)
     size_written = 0
     for waveforms in iter_waveforms(
             traces, spike_samples, spike_channels, n_samples_waveforms=n_samples_waveforms,
             cache=cache):
-        writer.append(waveforms * sample2unit)
+        if sample2unit is not None:
+            waveforms = waveforms * sample2unit
+        writer.append(waveforms.astype(dtype, copy=False))
         size_written += waveforms.size
     writer.close()
     assert prod(shape) == size_written